@@ -1,19 +1,17 @@
-import datetime
-from typing import List
+import asyncio
 
+from httpx import TransportError
 from nonebot import on_command, require
 from nonebot.adapters.satori import MessageSegment
 from nonebot.typing import T_State
 
 from .main import get_related_maps, get_related_map
 from .country_rank import get_score_list
-from .models import NewScore, Beatmap
-from .osu_network import osu_api
+from .osu_network import get_map_info
 
-require("nonebot_plugin_htmlrender")
 require('nonebot_plugin_alconna')
-from nonebot_plugin_htmlrender import md_to_pic
 from nonebot_plugin_alconna import UniMessage
+from .render import render_pic
 from .utils import split_msg
 
 ctb_recommend = on_command("ctb推荐", priority=11, block=True)
@@ -68,46 +66,33 @@ country_rank = on_command('地区排名', priority=11, block=True)
 
 @global_rank.handle(parameterless=[split_msg()])
 async def _(state: T_State):
-    scores = await get_score_list(state['para'], NGM[state["mode"]], state["mods"], False)
+    if not state['para'].isdigit():
+        await UniMessage.text("参数错误").finish(reply_to=True)
+    try:
+        scores, map_info = await asyncio.gather(
+            get_score_list(state['para'], NGM[state["mode"]], state["mods"], False),
+            get_map_info(state['para']),
+        )
+    except TransportError:
+        await UniMessage.text("获取谱面信息失败，请稍后再试").finish(reply_to=True)
     if not scores:
         await UniMessage.text("暂无成绩").finish()
-    map_info = await osu_api("map", mode=NGM[state["mode"]], map_id=state['para'])
-    map_info = Beatmap(**map_info)
-    pic = await render_pic(scores, map_info)
+    pic = await render_pic(scores, map_info, NGM[state["mode"]], state["mods"], False)
     await UniMessage.image(raw=pic).finish()
 
 
 @country_rank.handle(parameterless=[split_msg()])
 async def _(state: T_State):
-    scores = await get_score_list(state['para'], NGM[state["mode"]], state["mods"], True)
+    if not state['para'].isdigit():
+        await UniMessage.text("参数错误").finish(reply_to=True)
+    try:
+        scores, map_info = await asyncio.gather(
+            get_score_list(state['para'], NGM[state["mode"]], state["mods"], True),
+            get_map_info(state['para']),
+        )
+    except TransportError:
+        await UniMessage.text("获取谱面信息失败，请稍后再试").finish(reply_to=True)
     if not scores:
         await UniMessage.text("暂无成绩").finish()
-    map_info = await osu_api("map", mode=NGM[state["mode"]], map_id=state['para'])
-    map_info = Beatmap(**map_info)
-    pic = await render_pic(scores, map_info)
+    pic = await render_pic(scores, map_info, NGM[state["mode"]], state["mods"], True)
     await UniMessage.image(raw=pic).finish()
-
-
-async def render_pic(scores: List[NewScore], map_info: Beatmap):
-    md = f"### {map_info.beatmapset.title} [{map_info.version}]\n⭐{map_info.difficulty_rating:.2f}\n\n"
-    md += """| 排名 |      | 得分 | 准确率 | 玩家 | 最大连击 | Fruits | DRP MISS | MISS | PP   | 达成时间 | 模组 |
-| ---- | ---- | ---- | ------ | ---- | -------- | ------ | -------- | ---- | ---- | -------- | ---- |"""
-    for rank, score in enumerate(scores):
-        mods = [i.acronym for i in score.mods if i.acronym != "CL"]
-        play_time = datetime.datetime.strptime(score.ended_at, "%Y-%m-%dT%H:%M:%SZ") + datetime.timedelta(hours=8)
-        now = datetime.datetime.now()
-        time_delta = now - play_time
-        if time_delta.days > 365:
-            day = f"{time_delta.days // 365} 年前"
-        elif time_delta.days > 30:
-            day = f"{time_delta.days // 30} 月前"
-        elif time_delta.days >= 1:
-            day = f"{time_delta.days} 天前"
-        elif time_delta.seconds >= 3600:
-            day = f"{time_delta.seconds // 3600} 小时前"
-        elif time_delta.seconds >= 60:
-            day = f"{time_delta.seconds // 60} 分钟前"
-        else:
-            day = "刚刚"
-        md += f"\n| {rank + 1} | {score.rank} | {score.legacy_total_score} | {(score.accuracy * 100):.1f}% | {score.user.username} | {score.max_combo} | {score.statistics.great or 0} | {score.statistics.small_tick_miss or 0} | {score.statistics.miss or 0} | {score.pp:.0f} | {day} | {' '.join(mods)} |"
-    return await md_to_pic(md, width=1100)
@@ -6,3 +6,36 @@ class Config(BaseModel):
     osu_client: Optional[int] = None
     osu_key: Optional[str] = None
     osu_cookie: Optional[str] = None
+    osu_api_rate: float = 16
+    osu_api_burst: int = 20
+    osu_api_interactive_reserve: int = 4
+    osu_crawl_concurrency: int = 8
+    osu_crawl_max_age_days: int = 7
+    osu_proxy: Optional[str] = None
+    osu_http2: bool = True
+    osu_http_timeout: float = 100
+    osu_http_connect_timeout: float = 10
+    osu_http_max_connections: int = 100
+    osu_http_max_keepalive: int = 20
+    osu_prefetch_concurrency: int = 8
+    osu_pp_workers: int = 2
+    osu_pp_cache_size: int = 4096
+    osu_render_backend: str = "browser"
+    osu_render_font: Optional[str] = None
+    osu_render_pages: int = 2
+    osu_render_cache_size: int = 64
+    osu_leaderboard_ttl: float = 30
+    osu_leaderboard_stale: float = 300
+    osu_leaderboard_cache_size: int = 256
+    osu_binding_cache_size: int = 4096
+    osu_binding_cache_ttl: float = 600
+    osu_retry_attempts: int = 3
+    osu_retry_deadline: float = 60
+    osu_retry_budget_ratio: float = 0.2
+    osu_circuit_failures: int = 5
+    osu_circuit_reset: float = 30
+    osu_map_cache_ttl: float = 1800
+    osu_map_cache_size: int = 1024
+    osu_pack_level: int = 10
+    osu_pack_compact_ratio: float = 0.3
+    osu_graph_snapshot: bool = True
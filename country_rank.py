@@ -1,5 +1,14 @@
-import httpx
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable
+
+import orjson
+from loguru import logger
+
 from .models import NewScore
+from .network import get_client
+from .osu_network import api_limiter
 from nonebot import get_plugin_config
 from .config import Config
 
@@ -17,20 +26,80 @@ headers = {
 }
 
 
+class StaleWhileRevalidateCache:
+    """
+    ttl 内直接返回缓存；过期但未超过 stale 时先返回旧值，同时在后台刷新；更久的则等待重新获取
+
+    同一个键同时只有一个获取请求，并发的调用方共享结果。刷新失败时若还有旧值则继续使用旧值。
+    """
+
+    def __init__(self, ttl: float, stale: float, size: int = 256):
+        self.ttl = ttl
+        self.stale = stale
+        self.size = size
+        self._items: OrderedDict[Hashable, tuple[float, object]] = OrderedDict()
+        self._pending: dict[Hashable, asyncio.Task] = {}
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable]):
+        if (item := self._items.get(key)) is not None:
+            fetched_at, value = item
+            age = time.monotonic() - fetched_at
+            if age < self.ttl:
+                self._items.move_to_end(key)
+                return value
+            if age < self.ttl + self.stale:
+                self._items.move_to_end(key)
+                self._refresh(key, loader)
+                return value
+        try:
+            # shield 保证某个调用方被取消时不会取消其他调用方共享的请求
+            return await asyncio.shield(self._refresh(key, loader))
+        except Exception:
+            if item is not None:
+                logger.warning(f"刷新 {key} 失败，使用旧的缓存")
+                return item[1]
+            raise
+
+    def _refresh(self, key: Hashable, loader: Callable[[], Awaitable]) -> asyncio.Task:
+        if (task := self._pending.get(key)) is None:
+            task = self._pending[key] = asyncio.create_task(self._load(key, loader))
+            # 后台刷新没有调用方等待，取走异常避免 asyncio 报未处理的异常
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable]):
+        try:
+            value = await loader()
+        except Exception as e:
+            logger.warning(f"获取 {key} 失败: {e}")
+            raise
+        finally:
+            self._pending.pop(key, None)
+        self._items[key] = (time.monotonic(), value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+        return value
+
+
+leaderboard_cache = StaleWhileRevalidateCache(
+    plugin_config.osu_leaderboard_ttl, plugin_config.osu_leaderboard_stale, plugin_config.osu_leaderboard_cache_size
+)
+
+
 # 发送 GET 请求
 async def fetch_scores(url: str):
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers)
-        return [NewScore.parse_obj(i) for i in response.json()['scores']]  # 返回 JSON 数据
+    await api_limiter.acquire()
+    response = await get_client().get(url, headers=headers)
+    return [NewScore.parse_obj(i) for i in orjson.loads(response.content)['scores']]  # 返回 JSON 数据
 
 
-async def get_score_list(map_id: int, mode: str, mods: list[str], is_country: bool):
+async def get_score_list(map_id: int, mode: str, mods: list[str], is_country: bool) -> list[NewScore]:
     url = f"https://osu.ppy.sh/beatmaps/{map_id}/scores?mode={mode}"
     if mods:
         for i in mods:
             url += f"&mods[]={i}"
     if is_country:
         url += "&type=country"
-    data = await fetch_scores(url)
-    return data
-
+    key = (int(map_id), mode, tuple(mods or ()), "country" if is_country else "global")
+    return await leaderboard_cache.get(key, lambda: fetch_scores(url))
@@ -0,0 +1,182 @@
+import asyncio
+import datetime
+import json
+import time
+from contextlib import AsyncExitStack
+from pathlib import Path
+from typing import Optional
+
+from loguru import logger
+from nonebot import get_plugin_config
+from sqlmodel import select
+
+from .config import Config
+from .graph import export_snapshot, replace_player_bplist
+from .models import get_raw_connection, get_session, PlayerCrawlStateCatch, RankingEntry
+from .network import Priority, use_priority
+from .osu_network import get_ranking, get_best_scores, api_limiter, map_cache
+
+plugin_config = get_plugin_config(Config)
+checkpoint_path = Path() / "data" / "osu" / "crawl_checkpoint_fruits.json"
+
+
+class CrawlCheckpoint:
+    """
+    记录已完成的排行榜页数和未完成页中已处理的玩家
+
+    page 之前（含）的所有页都已处理完，done 为之后各页中已处理的玩家。
+    完成玩家时只在翻页或距上次保存超过 interval 秒时写文件；中断时少记的玩家会按爬取状态跳过或重新爬取。
+    """
+
+    def __init__(self, path: Path, page: int = 0, done: Optional[set[int]] = None, interval: float = 30):
+        self.path = path
+        self.page = page
+        self.done = done or set()
+        self.interval = interval
+        self._pending: dict[int, set[int]] = {}
+        self._page_uids: dict[int, list[int]] = {}
+        self._saved_at = time.monotonic()
+
+    @classmethod
+    def load(cls, path: Path) -> "CrawlCheckpoint":
+        if not path.exists():
+            return cls(path)
+        data = json.loads(path.read_text())
+        logger.info(f"从第 {data['page'] + 1} 页继续爬取，已完成 {len(data['done'])} 名玩家")
+        return cls(path, data["page"], set(data["done"]))
+
+    def save(self):
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"page": self.page, "done": sorted(self.done)}))
+        tmp.replace(self.path)
+        self._saved_at = time.monotonic()
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
+
+    def start_page(self, page: int, uids: list[int], skipped: set[int] = frozenset()) -> list[int]:
+        """登记一页玩家，skipped 直接视为已处理，返回其中尚未处理的玩家"""
+        self.done.update(skipped)
+        todo = [uid for uid in uids if uid not in self.done]
+        self._page_uids[page] = uids
+        self._pending[page] = set(todo)
+        self._advance()
+        self.save()
+        return todo
+
+    def finish(self, page: int, uid: int):
+        self.done.add(uid)
+        self._pending[page].discard(uid)
+        if self._advance() or time.monotonic() - self._saved_at >= self.interval:
+            self.save()
+
+    def _advance(self) -> bool:
+        """返回是否翻过了至少一页"""
+        advanced = False
+        while not self._pending.get(self.page + 1, True):
+            self.page += 1
+            del self._pending[self.page]
+            self.done.difference_update(self._page_uids.pop(self.page))
+            advanced = True
+        return advanced
+
+
+async def load_crawl_states() -> dict[int, PlayerCrawlStateCatch]:
+    async with get_session() as session:
+        return {i.player_id: i for i in (await session.exec(select(PlayerCrawlStateCatch))).all()}
+
+
+async def save_crawl_state(conn, entry: RankingEntry):
+    await conn.execute(
+        f"INSERT INTO {PlayerCrawlStateCatch.__tablename__} (player_id, pp, play_count, crawled_at) "
+        f"VALUES ($1, $2, $3, $4) ON CONFLICT (player_id) DO UPDATE "
+        f"SET pp = EXCLUDED.pp, play_count = EXCLUDED.play_count, crawled_at = EXCLUDED.crawled_at",
+        entry.user_id, entry.pp, entry.play_count, datetime.datetime.now(),
+    )
+
+
+def is_unchanged(entry: RankingEntry, state: Optional[PlayerCrawlStateCatch], max_age: datetime.timedelta) -> bool:
+    # 总 pp 不变说明 bp 没有变化；游玩次数变化不代表 bp 变化，只记录不作为依据
+    if state is None or datetime.datetime.now() - state.crawled_at > max_age:
+        return False
+    return abs(state.pp - entry.pp) < 1e-3
+
+
+async def crawl_bplist(
+    incremental: bool = False,
+    pages: int = 200,
+    concurrency: Optional[int] = None,
+    resume: bool = True,
+    force: bool = False,
+):
+    """
+    并发爬取排行榜玩家的 bp 并替换数据库中的旧记录
+
+    请求以 BATCH 优先级经过 api_limiter，交互命令的请求总是先放行；进度写入 checkpoint，中断后再次调用会从断点继续。
+    排行榜上总 pp 与上次爬取时相同的玩家会被跳过，force 为真时全部重新爬取。
+    incremental 为真时对 bp 发生变化的玩家同步增量更新关系表，无需再全量重建；
+    启用了关系图快照时，爬取结束后从关系表重新导出快照，查询能看到增量更新的结果。
+    """
+    concurrency = concurrency or plugin_config.osu_crawl_concurrency
+    max_age = datetime.timedelta(days=plugin_config.osu_crawl_max_age_days)
+    checkpoint = CrawlCheckpoint.load(checkpoint_path) if resume else CrawlCheckpoint(checkpoint_path)
+    states = {} if force else await load_crawl_states()
+    queue: asyncio.Queue[Optional[tuple[int, RankingEntry]]] = asyncio.Queue(maxsize=concurrency * 4)
+    skipped_count = 0
+    changed_count = 0
+
+    async def producer():
+        nonlocal skipped_count
+        try:
+            for page in range(checkpoint.page + 1, pages + 1):
+                entries = {i.user_id: i for i in await get_ranking("fruits", page)}
+                skipped = {uid for uid, i in entries.items() if is_unchanged(i, states.get(uid), max_age)}
+                skipped_count += len(skipped)
+                for uid in checkpoint.start_page(page, list(entries), skipped):
+                    await queue.put((page, entries[uid]))
+        finally:
+            for _ in range(concurrency):
+                await queue.put(None)
+
+    async def worker(conn):
+        nonlocal changed_count
+        while (item := await queue.get()) is not None:
+            page, entry = item
+            uid = entry.user_id
+            try:
+                bplist = await get_best_scores(uid, "fruits")
+                # bp 中带有谱面当前的 checksum，写入谱面缓存后离线重建也能发现谱面更新
+                await map_cache.observe_many((bp.beatmap_id, bp.checksum) for bp in bplist)
+                rows = [(bp.beatmap_id, bp.mod, bp_position, bp.pp) for bp_position, bp in enumerate(bplist)]
+                changed = await replace_player_bplist(conn, uid, rows, incremental)
+                await save_crawl_state(conn, entry)
+                changed_count += changed
+                logger.debug(f'{uid} {"updated" if changed else "ok"}')
+            except Exception as e:
+                # 单个玩家失败不阻塞整页，下次爬取时会重新处理
+                logger.warning(f"爬取玩家 {uid} 的 bp 失败: {e}")
+            checkpoint.finish(page, uid)
+
+    async with AsyncExitStack() as stack:
+        # 先打开全部连接再启动任务，连接失败时直接抛出，不会留下阻塞在队列上的生产者
+        conns = [await stack.enter_async_context(get_raw_connection()) for _ in range(concurrency)]
+        # 任务创建时复制当前 context，生产者和所有 worker 都继承 BATCH 优先级
+        with use_priority(Priority.BATCH):
+            producer_task = asyncio.create_task(producer())
+            workers = [asyncio.create_task(worker(conn)) for conn in conns]
+        try:
+            results = await asyncio.gather(*workers, return_exceptions=True)
+        except BaseException:
+            producer_task.cancel()
+            raise
+        for result in results:
+            if isinstance(result, BaseException):
+                # worker 异常退出后队列无人消费，生产者可能永远阻塞在 put 上
+                producer_task.cancel()
+                raise result
+        await producer_task
+    checkpoint.clear()
+    if incremental and changed_count and plugin_config.osu_graph_snapshot:
+        async with get_raw_connection() as conn:
+            await export_snapshot(conn)
+    logger.info(f"bp 爬取完成，跳过 {skipped_count} 名 pp 未变化的玩家，限速统计 {api_limiter.stats()}")
@@ -0,0 +1,31 @@
+from .engine import NodeIndex, RelationshipBuilder
+from .loader import StagingLoader
+from .migrate import migrate_mod_columns, migrate_relationship_tables
+from .relationship import (
+    apply_relationship_deltas,
+    refresh_neighbours,
+    replace_player_bplist,
+    write_neighbours,
+    write_relationships,
+)
+from .snapshot import GraphSnapshot, SnapshotStore, export_snapshot, snapshot_store, write_snapshot
+from .ss_pp import write_ss_pp
+
+__all__ = [
+    "GraphSnapshot",
+    "NodeIndex",
+    "RelationshipBuilder",
+    "SnapshotStore",
+    "StagingLoader",
+    "apply_relationship_deltas",
+    "export_snapshot",
+    "migrate_mod_columns",
+    "migrate_relationship_tables",
+    "refresh_neighbours",
+    "replace_player_bplist",
+    "snapshot_store",
+    "write_neighbours",
+    "write_relationships",
+    "write_snapshot",
+    "write_ss_pp",
+]
@@ -0,0 +1,142 @@
+from functools import lru_cache
+from typing import Iterator, Sequence
+
+import numpy as np
+
+
+class NodeIndex:
+    """(beatmap_id, mod) 与稠密整数 id 的双向映射"""
+
+    def __init__(self):
+        self._ids: dict[tuple[int, int], int] = {}
+        self.beatmap_ids: list[int] = []
+        self.mods: list[int] = []
+
+    def __len__(self) -> int:
+        return len(self.beatmap_ids)
+
+    def get(self, beatmap_id: int, mod: int) -> int:
+        key = (beatmap_id, mod)
+        node = self._ids.get(key)
+        if node is None:
+            node = len(self.beatmap_ids)
+            self._ids[key] = node
+            self.beatmap_ids.append(beatmap_id)
+            self.mods.append(int(mod))
+        return node
+
+    def lookup(self, beatmap_ids: Sequence[int], mods: Sequence[int]) -> np.ndarray:
+        return np.fromiter((self.get(b, m) for b, m in zip(beatmap_ids, mods)), dtype=np.int64, count=len(beatmap_ids))
+
+    def beatmap_id_array(self) -> np.ndarray:
+        return np.asarray(self.beatmap_ids, dtype=np.int64)
+
+    def mod_array(self) -> np.ndarray:
+        return np.asarray(self.mods, dtype=np.int64)
+
+
+@lru_cache(maxsize=128)
+def pair_indices(n: int) -> tuple[np.ndarray, np.ndarray]:
+    # 与 itertools.combinations(range(n), 2) 顺序一致
+    return np.triu_indices(n, 1)
+
+
+class RelationshipBuilder:
+    """
+    按玩家 bp 批量计算谱面共现关系值
+
+    每对谱面的关系值为 1/(1+Δpp) + 1/(1+Δbp)，较小的 beatmap_id 在前。
+    边以 (src << 32 | dst) 的 uint64 为键暂存，累计到 flush_pairs 对后合并一次，
+    合并结果是按键排序、去重后的两个数组。
+    """
+
+    def __init__(self, flush_pairs: int = 10_000_000):
+        self.nodes = NodeIndex()
+        self.flush_pairs = flush_pairs
+        self._pending_keys: list[np.ndarray] = []
+        self._pending_values: list[np.ndarray] = []
+        self._pending = 0
+        self._keys = np.empty(0, dtype=np.uint64)
+        self._values = np.empty(0, dtype=np.float64)
+
+    def add_player(
+        self,
+        beatmap_ids: Sequence[int],
+        mods: Sequence[int],
+        pps: Sequence[float],
+        positions: Sequence[int],
+        weight: float = 1.0,
+    ):
+        n = len(beatmap_ids)
+        if n < 2:
+            return
+        node = self.nodes.lookup(beatmap_ids, mods)
+        beatmap = np.asarray(beatmap_ids, dtype=np.int64)
+        pp = np.asarray(pps, dtype=np.float64)
+        position = np.asarray(positions, dtype=np.float64)
+        i, j = pair_indices(n)
+        score = 1 / (1 + np.abs(pp[i] - pp[j])) + 1 / (1 + np.abs(position[i] - position[j]))
+        if weight != 1.0:
+            score *= weight
+        # 同一谱面不同 mod 时按节点 id 定方向，保证同一对谱面只有一个键
+        swap = (beatmap[i] > beatmap[j]) | ((beatmap[i] == beatmap[j]) & (node[i] > node[j]))
+        src = np.where(swap, node[j], node[i]).astype(np.uint64)
+        dst = np.where(swap, node[i], node[j]).astype(np.uint64)
+        self._pending_keys.append((src << np.uint64(32)) | dst)
+        self._pending_values.append(score)
+        self._pending += len(score)
+        if self._pending >= self.flush_pairs:
+            self._reduce()
+
+    def _reduce(self):
+        if not self._pending_keys:
+            return
+        keys = np.concatenate([self._keys, *self._pending_keys])
+        values = np.concatenate([self._values, *self._pending_values])
+        self._pending_keys.clear()
+        self._pending_values.clear()
+        self._pending = 0
+        self._keys, inverse = np.unique(keys, return_inverse=True)
+        self._values = np.bincount(inverse.ravel(), weights=values, minlength=len(self._keys))
+
+    def __len__(self) -> int:
+        self._reduce()
+        return len(self._keys)
+
+    def iter_edges(self, batch_size: int = 1_000_000) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """按 (src, dst) 顺序分批产出 (src 节点, dst 节点, 关系值)"""
+        self._reduce()
+        for start in range(0, len(self._keys), batch_size):
+            keys = self._keys[start:start + batch_size]
+            yield (
+                (keys >> np.uint64(32)).astype(np.int64),
+                (keys & np.uint64(0xFFFFFFFF)).astype(np.int64),
+                self._values[start:start + batch_size],
+            )
+
+    def top_neighbours(
+        self, k: int, buckets: int = 8
+    ) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        把每条边展开为双向，产出每个节点关系值最高的 k 个邻居 (src, dst, 关系值, 名次)
+
+        按 src % buckets 分批处理以限制内存，每批内 src 有序、同一 src 按关系值降序。
+        """
+        self._reduce()
+        src = (self._keys >> np.uint64(32)).astype(np.int32)
+        dst = (self._keys & np.uint64(0xFFFFFFFF)).astype(np.int32)
+        not_loop = src != dst
+        for bucket in range(buckets):
+            forward = (src % buckets == bucket) & not_loop
+            backward = (dst % buckets == bucket) & not_loop
+            s = np.concatenate([src[forward], dst[backward]])
+            d = np.concatenate([dst[forward], src[backward]])
+            v = np.concatenate([self._values[forward], self._values[backward]])
+            if not len(s):
+                continue
+            order = np.lexsort((-v, s))
+            s, d, v = s[order], d[order], v[order]
+            starts = np.flatnonzero(np.r_[True, s[1:] != s[:-1]])
+            rank = np.arange(len(s)) - np.repeat(starts, np.diff(np.r_[starts, len(s)]))
+            keep = rank < k
+            yield s[keep], d[keep], v[keep], rank[keep]
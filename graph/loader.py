@@ -0,0 +1,90 @@
+from typing import Iterable, Optional, Sequence
+
+from loguru import logger
+
+
+class StagingLoader:
+    """
+    以 COPY 批量写入 {table}_staging，全部写完后在同一事务内替换正式表
+
+    线上查询在替换前始终读到旧的完整数据，替换后读到新的完整数据。
+    partition_by 不为空时 staging 表按同样的规则建为 hash 分区表，分区名为 {table}_p{n}。
+    """
+
+    def __init__(
+        self,
+        connection,
+        tables: Iterable[str],
+        columns: Sequence[str],
+        primary_key: Sequence[str],
+        indexes: Optional[dict[str, str]] = None,
+        partition_by: Optional[str] = None,
+        partitions: int = 0,
+    ):
+        self.connection = connection
+        self.tables = list(tables)
+        self.columns = list(columns)
+        self.primary_key = list(primary_key)
+        # 索引名 -> 索引列，命名为 ix_{table}_{name}
+        self.indexes = indexes or {}
+        self.partition_by = partition_by
+        self.partitions = partitions
+        self.rows = 0
+
+    async def __aenter__(self) -> "StagingLoader":
+        for table in self.tables:
+            await self.connection.execute(f'DROP TABLE IF EXISTS "{table}_staging"')
+            ddl = f'CREATE TABLE "{table}_staging" (LIKE "{table}" INCLUDING DEFAULTS)'
+            if self.partition_by:
+                ddl += f' PARTITION BY HASH ("{self.partition_by}")'
+            await self.connection.execute(ddl)
+            for i in range(self.partitions if self.partition_by else 0):
+                await self.connection.execute(
+                    f'CREATE TABLE "{table}_staging_p{i}" PARTITION OF "{table}_staging" '
+                    f"FOR VALUES WITH (MODULUS {self.partitions}, REMAINDER {i})"
+                )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.swap()
+        else:
+            await self.drop_staging()
+
+    async def copy(self, table: str, records: Iterable[tuple]):
+        records = list(records)
+        if not records:
+            return
+        await self.connection.copy_records_to_table(f"{table}_staging", records=records, columns=self.columns)
+        self.rows += len(records)
+
+    async def drop_staging(self):
+        for table in self.tables:
+            await self.connection.execute(f'DROP TABLE IF EXISTS "{table}_staging"')
+
+    async def swap(self):
+        key = ", ".join(f'"{i}"' for i in self.primary_key)
+        # 建索引放在数据写完之后，比边写边维护索引快得多
+        for table in self.tables:
+            await self.connection.execute(
+                f'ALTER TABLE "{table}_staging" ADD CONSTRAINT "{table}_staging_pkey" PRIMARY KEY ({key})'
+            )
+            for name, columns in self.indexes.items():
+                await self.connection.execute(f'CREATE INDEX "ix_{table}_staging_{name}" ON "{table}_staging" ({columns})')
+            await self.connection.execute(f'ANALYZE "{table}_staging"')
+        async with self.connection.transaction():
+            for table in self.tables:
+                await self.connection.execute(f'DROP TABLE IF EXISTS "{table}"')
+                await self.connection.execute(f'ALTER TABLE "{table}_staging" RENAME TO "{table}"')
+                for i in range(self.partitions if self.partition_by else 0):
+                    await self.connection.execute(f'ALTER TABLE "{table}_staging_p{i}" RENAME TO "{table}_p{i}"')
+                # 分区上的索引由 Postgres 自动命名，一并去掉 _staging 以免下次重建时重名
+                for row in await self.connection.fetch(
+                    "SELECT indexname FROM pg_indexes WHERE indexname LIKE $1 OR indexname LIKE $2",
+                    f"{table}\\_staging%", f"ix\\_{table}\\_staging%",
+                ):
+                    name = row["indexname"]
+                    await self.connection.execute(
+                        f'ALTER INDEX "{name}" RENAME TO "{name.replace(f"{table}_staging", table, 1)}"'
+                    )
+        logger.info(f"已替换 {len(self.tables)} 张表，共写入 {self.rows} 行")
@@ -0,0 +1,193 @@
+from loguru import logger
+from tqdm import tqdm
+
+from ..models import BeatmapRelationshipCatch, BeatmapNeighbourCatch, BeatmapSSPPCatch, PlayerBP100Catch, \
+    RELATIONSHIP_PARTITIONS, create_tables, get_raw_connection
+from ..osu_network.mods import mods_dic
+from .loader import StagingLoader
+from .relationship import RELATIONSHIP_COLUMNS, RELATIONSHIP_KEY, RELATIONSHIP_INDEXES, NEIGHBOUR_COLUMNS, NEIGHBOUR_K
+
+# 旧版按 (beatmap_id1 + beatmap_id2) % 10 分出的 10 张表
+LEGACY_TABLES = [f"beatmap_relationship_catch_{i}" for i in range(10)]
+# 把 "HDHR" 这样的 mod 字符串按两个字符一组转为 ModSet 位掩码，与 ModSet.parse 一致
+MODS_FUNCTION = (
+    "CREATE OR REPLACE FUNCTION osu_mods_to_int(mods text) RETURNS int AS $$ "
+    "SELECT coalesce(bit_or(m.bit), 0)::int FROM generate_series(1, length(mods), 2) AS g(i) "
+    "JOIN (VALUES " + ", ".join(f"('{k}', {v})" for k, v in mods_dic.items() if len(k) == 2 and v) + ") AS m(acronym, bit) "
+    "ON m.acronym = upper(substr(mods, g.i, 2)) "
+    "$$ LANGUAGE sql IMMUTABLE"
+)
+
+
+async def is_text_column(conn, table: str, column: str) -> bool:
+    data_type = await conn.fetchval(
+        "SELECT data_type FROM information_schema.columns WHERE table_name = $1 AND column_name = $2", table, column
+    )
+    return data_type in ("character varying", "text")
+
+
+async def rebuild_neighbours(conn):
+    """
+    从关系表重新计算整张相关谱面表，写入 staging 表后原子替换
+
+    相关谱面表的 mod 列仍是字符串时，staging 表同时转为位掩码整数列。
+    关系表的 mod 列还是字符串时跳过，由 migrate_mod_columns 转换关系表后再重建。
+    """
+    table = BeatmapRelationshipCatch.__tablename__
+    neighbour_table = BeatmapNeighbourCatch.__tablename__
+    if await is_text_column(conn, table, "beatmap_mod1"):
+        logger.info(f"{table} 的 mod 列还是字符串，转换后再重建相关谱面表")
+        return
+    convert = await is_text_column(conn, neighbour_table, "mod")
+    async with StagingLoader(conn, [neighbour_table], NEIGHBOUR_COLUMNS, NEIGHBOUR_COLUMNS[:3]) as loader:
+        if convert:
+            await conn.execute(MODS_FUNCTION)
+            await conn.execute(
+                f'ALTER TABLE "{neighbour_table}_staging" '
+                f"ALTER COLUMN mod TYPE int USING osu_mods_to_int(mod), "
+                f"ALTER COLUMN neighbour_mod TYPE int USING osu_mods_to_int(neighbour_mod)"
+            )
+        for i in tqdm(range(RELATIONSHIP_PARTITIONS), desc="neighbour"):
+            status = await conn.execute(
+                f'INSERT INTO "{neighbour_table}_staging" ({", ".join(NEIGHBOUR_COLUMNS)}) '
+                f"SELECT s.beatmap_id1, s.beatmap_mod1, "
+                f"(row_number() OVER (PARTITION BY s.beatmap_id1, s.beatmap_mod1 ORDER BY e.v DESC) - 1)::int, "
+                f"e.b, e.bm, e.v "
+                f'FROM (SELECT DISTINCT beatmap_id1, beatmap_mod1 FROM "{table}_p{i}") AS s '
+                f"CROSS JOIN LATERAL (SELECT beatmap_id2 AS b, beatmap_mod2 AS bm, relationship_value AS v "
+                f'FROM "{table}" '
+                f"WHERE beatmap_id1 = s.beatmap_id1 AND beatmap_mod1 = s.beatmap_mod1 "
+                f"AND NOT (beatmap_id2 = s.beatmap_id1 AND beatmap_mod2 = s.beatmap_mod1) "
+                f"ORDER BY relationship_value DESC LIMIT {NEIGHBOUR_K}) AS e"
+            )
+            loader.rows += int(status.split()[-1])
+
+
+async def migrate_relationship_tables(drop_legacy: bool = False):
+    """
+    把旧的 10 张关系分表迁移到按源谱面分区的 beatmap_relationship_catch
+
+    数据写入 staging 分区表，全部完成后原子替换，之后从新关系表重建相关谱面表。
+    查询只读新表，替换和重建完成前相关谱面查询没有结果，应在维护时段运行。
+    旧表每对谱面只存一个方向，迁移时展开为双向，同一对谱面的多行合并求和。
+    同一对谱面的两个方向 hash 到同一张旧表，所以可以逐表合并。
+    迁移期间不要运行增量爬取，否则这段时间写入新表的增量会在替换时丢失。
+    """
+    await create_tables()
+    table = BeatmapRelationshipCatch.__tablename__
+    columns = ", ".join(RELATIONSHIP_COLUMNS)
+    async with get_raw_connection() as conn:
+        legacy = [i for i in LEGACY_TABLES if await conn.fetchval("SELECT to_regclass($1)", i)]
+        if not legacy:
+            logger.info("没有需要迁移的旧关系表")
+            return
+        await conn.execute(MODS_FUNCTION)
+        # 新表的 mod 列已经是位掩码时需要转换旧表的 mod 字符串
+        mod = "osu_mods_to_int({})" if not await is_text_column(conn, table, "beatmap_mod1") else "{}"
+        async with StagingLoader(
+            conn,
+            [table],
+            RELATIONSHIP_COLUMNS,
+            RELATIONSHIP_KEY,
+            RELATIONSHIP_INDEXES,
+            partition_by="beatmap_id1",
+            partitions=RELATIONSHIP_PARTITIONS,
+        ) as loader:
+            for legacy_table in tqdm(legacy, desc="migrate"):
+                status = await conn.execute(
+                    f'INSERT INTO "{table}_staging" ({columns}) '
+                    f"SELECT a, am, b, bm, sum(v) FROM ("
+                    f'SELECT beatmap_id1, {mod.format("beatmap_mod1")}, beatmap_id2, {mod.format("beatmap_mod2")}, '
+                    f'relationship_value FROM "{legacy_table}" '
+                    f"UNION ALL "
+                    f'SELECT beatmap_id2, {mod.format("beatmap_mod2")}, beatmap_id1, {mod.format("beatmap_mod1")}, '
+                    f'relationship_value FROM "{legacy_table}" '
+                    f"WHERE NOT (beatmap_id1 = beatmap_id2 AND beatmap_mod1 = beatmap_mod2)"
+                    f") AS e(a, am, b, bm, v) WHERE NOT (a = b AND am = bm) GROUP BY a, am, b, bm"
+                )
+                loader.rows += int(status.split()[-1])
+        await rebuild_neighbours(conn)
+        if drop_legacy:
+            for legacy_table in legacy:
+                await conn.execute(f'DROP TABLE IF EXISTS "{legacy_table}"')
+            logger.info(f"已删除 {len(legacy)} 张旧关系表")
+
+
+async def migrate_mod_columns():
+    """
+    把各表中 "HDHR" 形式的 mod 字符串列转为 ModSet 位掩码整数列
+
+    不同字符串可能转为同一个位掩码（如 CL、未知 mod 都为 0）：
+    玩家 bp 保留名次靠前的一条，SS pp 任取一条，关系表重新分组求和，相关谱面列表从新的关系表重新计算。
+    已经是整数列的表会被跳过，可以重复执行。
+    """
+    await create_tables()
+    async with get_raw_connection() as conn:
+        await conn.execute(MODS_FUNCTION)
+        for model, order in ((PlayerBP100Catch, "bp_position"), (BeatmapSSPPCatch, None)):
+            table = model.__tablename__
+            if not await is_text_column(conn, table, "mod"):
+                continue
+            key = [i for i in model.__table__.primary_key.columns.keys() if i not in ("mod", "bp_position")]
+            match = " AND ".join(f"a.{i} = b.{i}" for i in key)
+            keep = f"(a.{order}, a.ctid) > (b.{order}, b.ctid)" if order else "a.ctid > b.ctid"
+            async with conn.transaction():
+                await conn.execute(
+                    f"DELETE FROM {table} AS a USING {table} AS b WHERE {match} "
+                    f"AND osu_mods_to_int(a.mod) = osu_mods_to_int(b.mod) AND {keep}"
+                )
+                await conn.execute(f"ALTER TABLE {table} ALTER COLUMN mod TYPE int USING osu_mods_to_int(mod)")
+            logger.info(f"已转换 {table}.mod")
+
+        table = BeatmapRelationshipCatch.__tablename__
+        relationship_converted = await is_text_column(conn, table, "beatmap_mod1")
+        if relationship_converted:
+            columns = ", ".join(RELATIONSHIP_COLUMNS)
+            async with StagingLoader(
+                conn,
+                [table],
+                RELATIONSHIP_COLUMNS,
+                RELATIONSHIP_KEY,
+                RELATIONSHIP_INDEXES,
+                partition_by="beatmap_id1",
+                partitions=RELATIONSHIP_PARTITIONS,
+            ) as loader:
+                await conn.execute(
+                    f'ALTER TABLE "{table}_staging" '
+                    f"ALTER COLUMN beatmap_mod1 TYPE int USING osu_mods_to_int(beatmap_mod1), "
+                    f"ALTER COLUMN beatmap_mod2 TYPE int USING osu_mods_to_int(beatmap_mod2)"
+                )
+                # 分区键没有变化，逐个分区转换
+                for i in tqdm(range(RELATIONSHIP_PARTITIONS), desc="relationship"):
+                    status = await conn.execute(
+                        f'INSERT INTO "{table}_staging" ({columns}) '
+                        f"SELECT * FROM (SELECT beatmap_id1, osu_mods_to_int(beatmap_mod1) AS am, "
+                        f"beatmap_id2, osu_mods_to_int(beatmap_mod2) AS bm, sum(relationship_value) "
+                        f'FROM "{table}_p{i}" GROUP BY 1, 2, 3, 4) AS e '
+                        f"WHERE NOT (beatmap_id1 = beatmap_id2 AND am = bm)"
+                    )
+                    loader.rows += int(status.split()[-1])
+
+        # 关系值重新求和后相关谱面列表也要重新计算
+        if relationship_converted or await is_text_column(conn, BeatmapNeighbourCatch.__tablename__, "mod"):
+            await rebuild_neighbours(conn)
+
+
+async def main():
+    """
+    依次迁移旧关系分表和 mod 字符串列
+
+    导入插件包时会调用 require、get_plugin_config，不能用 python -m 直接运行本模块，
+    需要在 bot 的环境中先初始化 nonebot 并加载插件，例如：
+
+        import asyncio
+        import nonebot
+
+        nonebot.init()
+        nonebot.load_plugin("nonebot_plugin_osubot_addon")
+        from nonebot_plugin_osubot_addon.graph.migrate import main
+
+        asyncio.run(main())
+    """
+    await migrate_relationship_tables()
+    await migrate_mod_columns()
@@ -0,0 +1,164 @@
+from typing import Iterable, Iterator, Sequence
+
+import numpy as np
+from tqdm import tqdm
+
+from ..models import PlayerBP100Catch, BeatmapNeighbourCatch, BeatmapRelationshipCatch, RELATIONSHIP_PARTITIONS
+from .engine import RelationshipBuilder
+from .loader import StagingLoader
+
+RELATIONSHIP_COLUMNS = ("beatmap_id1", "beatmap_mod1", "beatmap_id2", "beatmap_mod2", "relationship_value")
+RELATIONSHIP_KEY = RELATIONSHIP_COLUMNS[:4]
+RELATIONSHIP_INDEXES = {"source": '"beatmap_id1", "beatmap_mod1", "relationship_value" DESC'}
+NEIGHBOUR_COLUMNS = ("beatmap_id", "mod", "rank", "neighbour_id", "neighbour_mod", "relationship_value")
+# 每个谱面保留的相关谱面数量
+NEIGHBOUR_K = 100
+# 增量更新后关系值低于该阈值视为该对谱面已无关联
+EPSILON = 1e-9
+# 增量更新关系表时持有的事务级 advisory lock，多个爬虫 worker 的更新依次执行，避免互相死锁
+GRAPH_LOCK_KEY = 0x6F73755F72656C
+
+
+def iter_relationship_records(builder: RelationshipBuilder, skip_zero: bool = False) -> Iterator[Iterator[tuple]]:
+    """把每条边展开为双向两行，按批产出关系表记录"""
+    nodes = builder.nodes
+    beatmap_ids = nodes.beatmap_id_array()
+    mods = nodes.mod_array()
+    for src, dst, values in builder.iter_edges():
+        if skip_zero:
+            keep = np.abs(values) > EPSILON
+            src, dst, values = src[keep], dst[keep], values[keep]
+        reverse = src != dst
+        src, dst = np.concatenate([src, dst[reverse]]), np.concatenate([dst, src[reverse]])
+        values = np.concatenate([values, values[reverse]])
+        yield zip(
+            beatmap_ids[src].tolist(),
+            mods[src].tolist(),
+            beatmap_ids[dst].tolist(),
+            mods[dst].tolist(),
+            values.tolist(),
+        )
+
+
+async def write_relationships(conn, builder: RelationshipBuilder):
+    """全量重建：写入 staging 表后原子替换"""
+    table = BeatmapRelationshipCatch.__tablename__
+    async with StagingLoader(
+        conn,
+        [table],
+        RELATIONSHIP_COLUMNS,
+        RELATIONSHIP_KEY,
+        RELATIONSHIP_INDEXES,
+        partition_by="beatmap_id1",
+        partitions=RELATIONSHIP_PARTITIONS,
+    ) as loader:
+        for records in tqdm(iter_relationship_records(builder), desc="relationship"):
+            await loader.copy(table, records)
+
+
+async def apply_relationship_deltas(conn, builder: RelationshipBuilder):
+    """把 builder 中的关系值作为增量累加到关系表，需在事务内调用"""
+    table = BeatmapRelationshipCatch.__tablename__
+    columns = ", ".join(RELATIONSHIP_COLUMNS)
+    key = ", ".join(RELATIONSHIP_KEY)
+    match = " AND ".join(f"t.{i} = d.{i}" for i in RELATIONSHIP_KEY)
+    await conn.execute(
+        f'CREATE TEMP TABLE IF NOT EXISTS relationship_delta (LIKE "{table}" INCLUDING DEFAULTS) ON COMMIT DELETE ROWS'
+    )
+    for records in iter_relationship_records(builder, skip_zero=True):
+        records = list(records)
+        if not records:
+            continue
+        await conn.copy_records_to_table("relationship_delta", records=records, columns=RELATIONSHIP_COLUMNS)
+        await conn.execute(
+            f'INSERT INTO "{table}" AS t ({columns}) SELECT {columns} FROM relationship_delta ORDER BY {key} '
+            f'ON CONFLICT ({key}) DO UPDATE SET relationship_value = t.relationship_value + EXCLUDED.relationship_value'
+        )
+        await conn.execute(
+            f'DELETE FROM "{table}" AS t USING relationship_delta AS d '
+            f'WHERE {match} AND t.relationship_value <= {EPSILON}'
+        )
+        await conn.execute("TRUNCATE relationship_delta")
+
+
+async def write_neighbours(conn, builder: RelationshipBuilder):
+    """全量重建每个谱面的前 NEIGHBOUR_K 个相关谱面（双向）"""
+    table = BeatmapNeighbourCatch.__tablename__
+    nodes = builder.nodes
+    beatmap_ids = nodes.beatmap_id_array()
+    mods = nodes.mod_array()
+    async with StagingLoader(conn, [table], NEIGHBOUR_COLUMNS, NEIGHBOUR_COLUMNS[:3]) as loader:
+        for src, dst, values, rank in tqdm(builder.top_neighbours(NEIGHBOUR_K), desc="neighbour"):
+            await loader.copy(table, zip(
+                beatmap_ids[src].tolist(),
+                mods[src].tolist(),
+                rank.tolist(),
+                beatmap_ids[dst].tolist(),
+                mods[dst].tolist(),
+                values.tolist(),
+            ))
+
+
+async def refresh_neighbours(conn, nodes: Iterable[tuple[int, int]]):
+    """从关系表重新计算指定谱面的相关谱面列表，用于增量更新之后"""
+    nodes = list(nodes)
+    if not nodes:
+        return
+    table = BeatmapNeighbourCatch.__tablename__
+    beatmap_ids, mods = zip(*nodes)
+    await conn.execute(
+        f"DELETE FROM {table} AS n USING unnest($1::int[], $2::int[]) AS s(beatmap_id, mod) "
+        f"WHERE n.beatmap_id = s.beatmap_id AND n.mod = s.mod",
+        list(beatmap_ids), list(mods),
+    )
+    await conn.execute(
+        f"INSERT INTO {table} ({', '.join(NEIGHBOUR_COLUMNS)}) "
+        f"SELECT s.beatmap_id, s.mod, (row_number() OVER (PARTITION BY s.beatmap_id, s.mod ORDER BY e.v DESC) - 1)::int, "
+        f"e.b, e.bm, e.v "
+        f"FROM unnest($1::int[], $2::int[]) AS s(beatmap_id, mod) "
+        f"CROSS JOIN LATERAL (SELECT beatmap_id2 AS b, beatmap_mod2 AS bm, relationship_value AS v "
+        f"FROM {BeatmapRelationshipCatch.__tablename__} "
+        f"WHERE beatmap_id1 = s.beatmap_id AND beatmap_mod1 = s.mod "
+        f"AND NOT (beatmap_id2 = s.beatmap_id AND beatmap_mod2 = s.mod) "
+        f"ORDER BY relationship_value DESC LIMIT $3) AS e",
+        list(beatmap_ids), list(mods), NEIGHBOUR_K,
+    )
+
+
+async def replace_player_bplist(conn, uid: int, rows: Sequence[tuple[int, int, int, float]], incremental: bool) -> bool:
+    """
+    用最新的 bp 替换玩家记录，rows 为 (beatmap_id, mod, bp_position, pp)
+
+    incremental 为真时在同一事务内减去旧 bp 的关系值并加上新 bp 的关系值；
+    关系表的更新持有 GRAPH_LOCK_KEY，同一时间只有一个玩家的增量在写入。
+    返回玩家 bp 是否发生了变化。
+    """
+    table = PlayerBP100Catch.__tablename__
+    rows = sorted(rows, key=lambda x: x[2])
+    async with conn.transaction():
+        old = await conn.fetch(
+            f"SELECT beatmap_id, mod, bp_position, pp FROM {table} WHERE player_id = $1 ORDER BY bp_position FOR UPDATE",
+            uid,
+        )
+        old = [tuple(i) for i in old]
+        if old == rows:
+            return False
+        await conn.execute(f"DELETE FROM {table} WHERE player_id = $1", uid)
+        if rows:
+            beatmap_ids, mods, positions, pps = zip(*rows)
+            await conn.execute(
+                f"INSERT INTO {table} (player_id, beatmap_id, mod, bp_position, pp) "
+                f"SELECT $1, * FROM unnest($2::int[], $3::int[], $4::int[], $5::float8[]) "
+                f"ON CONFLICT DO NOTHING",
+                uid, list(beatmap_ids), list(mods), list(positions), list(pps),
+            )
+        if incremental:
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", GRAPH_LOCK_KEY)
+            builder = RelationshipBuilder()
+            for bplist, weight in ((old, -1.0), (rows, 1.0)):
+                if bplist:
+                    beatmap_ids, mods, positions, pps = zip(*bplist)
+                    builder.add_player(beatmap_ids, mods, pps, positions, weight=weight)
+            await apply_relationship_deltas(conn, builder)
+            await refresh_neighbours(conn, {(i[0], i[1]) for i in old + rows})
+    return True
@@ -0,0 +1,222 @@
+import json
+import shutil
+import time
+from pathlib import Path
+from typing import Iterable, Optional
+
+import numpy as np
+from loguru import logger
+from nonebot import get_plugin_config
+
+from ..config import Config
+from ..models import BeatmapRelationshipCatch, BeatmapSSPPCatch
+from .engine import RelationshipBuilder
+
+plugin_config = get_plugin_config(Config)
+snapshot_path = Path() / "data" / "osu" / "graph"
+# 快照中每个谱面保留的相关谱面数量，比 NEIGHBOUR_K 多留一些，按 mod 过滤后仍有足够的候选
+SNAPSHOT_K = 200
+SNAPSHOT_FILES = ("keys", "offsets", "neighbours", "weights", "pp")
+
+
+def node_keys(beatmap_ids: np.ndarray, mods: np.ndarray) -> np.ndarray:
+    return (beatmap_ids.astype(np.uint64) << np.uint64(32)) | mods.astype(np.uint64)
+
+
+async def write_snapshot(conn, builder: RelationshipBuilder, directory: Path = snapshot_path, k: int = SNAPSHOT_K):
+    """全量重建后由 builder 直接导出快照"""
+    nodes = builder.nodes
+    keys = node_keys(nodes.beatmap_id_array(), nodes.mod_array())
+    src, dst, values, ranks = [], [], [], []
+    for s, d, v, rank in builder.top_neighbours(k):
+        src.append(keys[s])
+        dst.append(keys[d])
+        values.append(v.astype(np.float32))
+        ranks.append(rank.astype(np.int32))
+    await save_snapshot(conn, src, dst, values, ranks, directory, k)
+
+
+async def export_snapshot(conn, directory: Path = snapshot_path, k: int = SNAPSHOT_K, batch_size: int = 500000):
+    """
+    从关系表重新导出快照，用于增量爬取之后
+
+    增量更新只修改数据库，不重新导出的话快照中仍是上次全量重建时的关系值。
+    """
+    src, dst, values, ranks = [], [], [], []
+    async with conn.transaction():
+        cursor = await conn.cursor(
+            f"SELECT beatmap_id1, beatmap_mod1, beatmap_id2, beatmap_mod2, relationship_value, rank FROM ("
+            f"SELECT *, (row_number() OVER (PARTITION BY beatmap_id1, beatmap_mod1 "
+            f"ORDER BY relationship_value DESC) - 1)::int AS rank "
+            f"FROM {BeatmapRelationshipCatch.__tablename__} "
+            f"WHERE NOT (beatmap_id1 = beatmap_id2 AND beatmap_mod1 = beatmap_mod2)) AS r WHERE rank < $1",
+            k,
+        )
+        while rows := await cursor.fetch(batch_size):
+            beatmap_id1, mod1, beatmap_id2, mod2, value, rank = (np.asarray(i) for i in zip(*rows))
+            src.append(node_keys(beatmap_id1, mod1))
+            dst.append(node_keys(beatmap_id2, mod2))
+            values.append(value.astype(np.float32))
+            ranks.append(rank.astype(np.int32))
+    await save_snapshot(conn, src, dst, values, ranks, directory, k)
+
+
+async def save_snapshot(
+    conn,
+    src: list[np.ndarray],
+    dst: list[np.ndarray],
+    values: list[np.ndarray],
+    ranks: list[np.ndarray],
+    directory: Path,
+    k: int,
+):
+    """
+    写入关系图的只读 CSR 快照，供插件在不连接数据库的情况下查询
+
+    src、dst 为边两端节点的键 (beatmap_id << 32 | mod)，ranks 为边在源节点邻居中的名次。
+    节点按键排序编号，keys[i] 为节点 i 的键，用二分查找定位节点；
+    节点 i 的邻居为 neighbours[offsets[i]:offsets[i + 1]]，按关系值降序，关系值在 weights 中；
+    pp 为节点的 SS pp，未计算的为 NaN。
+    写入新目录后替换 CURRENT 文件，正在运行的插件会自动切换到新快照。
+    """
+    src = np.concatenate(src) if src else np.empty(0, dtype=np.uint64)
+    dst = np.concatenate(dst) if dst else np.empty(0, dtype=np.uint64)
+    values = np.concatenate(values) if values else np.empty(0, dtype=np.float32)
+    ranks = np.concatenate(ranks) if ranks else np.empty(0, dtype=np.int32)
+    keys = np.unique(np.concatenate([src, dst]))
+    src = np.searchsorted(keys, src).astype(np.int32)
+    dst = np.searchsorted(keys, dst).astype(np.int32)
+    edge_order = np.lexsort((ranks, src))
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=len(keys)), out=offsets[1:])
+
+    pp = np.full(len(keys), np.nan, dtype=np.float32)
+    rows = await conn.fetch(f"SELECT beatmap_id, mod, pp FROM {BeatmapSSPPCatch.__tablename__}")
+    if rows and len(keys):
+        beatmap_ids, mods, pps = (np.asarray(i) for i in zip(*rows))
+        pp_keys = node_keys(beatmap_ids, mods)
+        position = np.searchsorted(keys, pp_keys).clip(max=len(keys) - 1)
+        found = keys[position] == pp_keys
+        pp[position[found]] = np.asarray(pps, dtype=np.float32)[found]
+
+    directory.mkdir(parents=True, exist_ok=True)
+    # 同一秒内导出两次时靠毫秒区分，名字按时间排序
+    name = f"snapshot-{time.strftime('%Y%m%d%H%M%S')}{int(time.time() * 1000) % 1000:03d}"
+    tmp = directory / f"{name}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir()
+    np.save(tmp / "keys.npy", keys)
+    np.save(tmp / "offsets.npy", offsets)
+    np.save(tmp / "neighbours.npy", dst[edge_order])
+    np.save(tmp / "weights.npy", values[edge_order])
+    np.save(tmp / "pp.npy", pp)
+    (tmp / "meta.json").write_text(json.dumps({"nodes": len(keys), "edges": len(dst), "k": k}))
+    tmp.rename(directory / name)
+    current = directory / "CURRENT.tmp"
+    current.write_text(name)
+    current.replace(directory / "CURRENT")
+    # 保留上一个快照，仍在读取它的进程不受影响
+    for old in sorted(i for i in directory.glob("snapshot-*") if i.is_dir() and i.name != name)[:-1]:
+        shutil.rmtree(old, ignore_errors=True)
+    logger.info(f"已导出关系图快照 {name}，{len(keys)} 个节点，{len(dst)} 条边")
+
+
+class GraphSnapshot:
+    """以 numpy memmap 只读打开的关系图快照"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.keys, self.offsets, self.neighbours, self.weights, self.pp = (
+            np.load(path / f"{i}.npy", mmap_mode="r") for i in SNAPSHOT_FILES
+        )
+
+    def node(self, beatmap_id: int, mod: int) -> Optional[int]:
+        key = np.uint64((beatmap_id << 32) | mod)
+        position = int(np.searchsorted(self.keys, key))
+        if position < len(self.keys) and self.keys[position] == key:
+            return position
+        return None
+
+    def decode(self, nodes: np.ndarray) -> tuple[list[int], list[int]]:
+        keys = self.keys[nodes]
+        return (keys >> np.uint64(32)).astype(np.int64).tolist(), (keys & np.uint64(0xFFFFFFFF)).astype(np.int64).tolist()
+
+    def neighbours_of(self, node: int, mod: Optional[int] = None, limit: Optional[int] = None) -> tuple[np.ndarray, np.ndarray]:
+        """节点的相关谱面及关系值，按关系值降序；mod 不为空时只保留该 mod 的谱面"""
+        start, end = self.offsets[node], self.offsets[node + 1]
+        neighbours, weights = self.neighbours[start:end], self.weights[start:end]
+        if mod is not None:
+            keep = (self.keys[neighbours] & np.uint64(0xFFFFFFFF)) == np.uint64(mod)
+            neighbours, weights = neighbours[keep], weights[keep]
+        return neighbours[:limit], weights[:limit]
+
+    def related(self, beatmap_id: int, mod: int, limit: int) -> list[tuple[int, int, float]]:
+        if (node := self.node(beatmap_id, mod)) is None:
+            return []
+        neighbours, weights = self.neighbours_of(node, limit=limit)
+        beatmap_ids, mods = self.decode(neighbours)
+        return list(zip(beatmap_ids, mods, weights.tolist()))
+
+    def candidates(
+        self, sources: Iterable[tuple[int, int]], mods: int, min_pp: float, per_source: int, limit: int
+    ) -> dict[tuple[int, int], tuple[float, Optional[float]]]:
+        """与 main.get_candidates 相同的查询：每个源谱面取前 per_source 个，同一谱面取最大关系值"""
+        source_nodes = {node for i in sources if (node := self.node(*i)) is not None}
+        best: dict[int, float] = {}
+        for node in source_nodes:
+            neighbours, weights = self.neighbours_of(node, mods or None, per_source)
+            for neighbour, weight in zip(neighbours.tolist(), weights.tolist()):
+                if neighbour not in source_nodes and weight > best.get(neighbour, -np.inf):
+                    best[neighbour] = weight
+        if not best:
+            return {}
+        nodes = np.fromiter(best, dtype=np.int64, count=len(best))
+        weights = np.fromiter(best.values(), dtype=np.float64, count=len(best))
+        pp = self.pp[nodes]
+        keep = np.isnan(pp) | (pp > min_pp)
+        nodes, weights, pp = nodes[keep], weights[keep], pp[keep]
+        order = np.argsort(-weights, kind="stable")[:limit]
+        beatmap_ids, node_mods = self.decode(nodes[order])
+        return {
+            (beatmap_id, mod): (weight, None if np.isnan(value) else round(float(value), 2))
+            for beatmap_id, mod, weight, value in zip(beatmap_ids, node_mods, weights[order].tolist(), pp[order].tolist())
+        }
+
+
+class SnapshotStore:
+    """持有当前快照，CURRENT 文件变化时重新打开，检查间隔为 interval 秒"""
+
+    def __init__(self, directory: Path = snapshot_path, interval: float = 5, enabled: bool = True):
+        self.directory = directory
+        self.interval = interval
+        self.enabled = enabled
+        self._snapshot: Optional[GraphSnapshot] = None
+        self._name: Optional[str] = None
+        self._checked = 0.0
+
+    def get(self) -> Optional[GraphSnapshot]:
+        """没有快照或未启用时返回 None，调用方改为查询数据库"""
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        if now - self._checked >= self.interval:
+            self._checked = now
+            self._reload()
+        return self._snapshot
+
+    def _reload(self):
+        try:
+            name = (self.directory / "CURRENT").read_text().strip()
+        except OSError:
+            return
+        if name == self._name:
+            return
+        try:
+            self._snapshot = GraphSnapshot(self.directory / name)
+            self._name = name
+            logger.info(f"已加载关系图快照 {name}")
+        except (OSError, ValueError) as e:
+            logger.warning(f"加载关系图快照 {name} 失败: {e}")
+
+
+snapshot_store = SnapshotStore(enabled=plugin_config.osu_graph_snapshot)
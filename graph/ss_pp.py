@@ -0,0 +1,77 @@
+import asyncio
+from importlib.metadata import version
+from typing import Iterable, Optional
+
+from httpx import TransportError
+from loguru import logger
+from sqlmodel import select
+from tqdm import tqdm
+
+from ..models import BeatmapSSPPCatch, get_session
+from ..network import Priority, use_priority
+from ..osu_network import map_cache, prefetcher, pp_service
+from .engine import NodeIndex
+
+rosu_version = version("rosu-pp-py")
+
+
+async def current_checksums(beatmap_ids: Iterable[int], concurrency: int = 16) -> dict[int, Optional[str]]:
+    """
+    从谱面缓存取每个谱面当前的 checksum
+
+    稳定状态的谱面直接读本地缓存，爬虫在 bp 中观察到新 checksum 的谱面和其他状态的过期谱面才请求 API。
+    请求失败的谱面为 None，沿用 pack 中已有的内容。
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def checksum(beatmap_id: int) -> Optional[str]:
+        async with semaphore:
+            try:
+                return (await map_cache.get(beatmap_id)).checksum
+            except TransportError as e:
+                logger.warning(f"获取谱面 {beatmap_id} 的 checksum 失败: {e}")
+                return None
+
+    beatmap_ids = list(dict.fromkeys(beatmap_ids))
+    with use_priority(Priority.BATCH):
+        checksums = await asyncio.gather(*(checksum(i) for i in beatmap_ids))
+    return dict(zip(beatmap_ids, checksums))
+
+
+async def write_ss_pp(conn, nodes: NodeIndex, batch_size: int = 5000):
+    """
+    为关系图中的每个 (beatmap_id, mod) 预先计算 SS pp
+
+    只重新计算新节点、.osu 文件 md5 变化或 rosu-pp 版本变化的节点，md5 直接取自 beatmap pack 的索引。
+    预取时传入谱面当前的 checksum，pack 中已过期的 .osu 文件会重新下载，对应节点随之重新计算。
+    """
+    async with get_session() as session:
+        existing = {
+            (i.beatmap_id, i.mod): (i.checksum, i.rosu_version)
+            for i in (await session.exec(select(BeatmapSSPPCatch))).all()
+        }
+    checksums = await current_checksums(nodes.beatmap_ids)
+    with use_priority(Priority.BATCH):
+        entries = await prefetcher.prefetch(nodes.beatmap_ids, checksums)
+    stale = [
+        (beatmap_id, mod)
+        for beatmap_id, mod in zip(nodes.beatmap_ids, nodes.mods)
+        if entries[beatmap_id] is not None
+        and existing.get((beatmap_id, mod)) != (entries[beatmap_id].checksum, rosu_version)
+    ]
+    logger.info(f"共 {len(nodes)} 个节点，需要重新计算 {len(stale)} 个节点的 SS pp")
+    table = BeatmapSSPPCatch.__tablename__
+    for start in tqdm(range(0, len(stale), batch_size), desc="ss pp"):
+        batch = stale[start:start + batch_size]
+        pps = await pp_service.ss_pp_batch([(entries[i[0]], i[1], "catch") for i in batch])
+        records = [(i[0], i[1], pp, entries[i[0]].checksum) for i, pp in zip(batch, pps) if pp is not None]
+        if not records:
+            continue
+        beatmap_ids, mods, values, checksum = zip(*records)
+        await conn.execute(
+            f"INSERT INTO {table} (beatmap_id, mod, pp, checksum, rosu_version) "
+            f"SELECT *, $5 FROM unnest($1::int[], $2::int[], $3::float8[], $4::varchar[]) "
+            f"ON CONFLICT (beatmap_id, mod) DO UPDATE "
+            f"SET pp = EXCLUDED.pp, checksum = EXCLUDED.checksum, rosu_version = EXCLUDED.rosu_version",
+            list(beatmap_ids), list(mods), list(values), list(checksum), rosu_version,
+        )
@@ -1,51 +1,52 @@
-import itertools
-from collections import defaultdict
+import asyncio
+from typing import Optional
+
+from loguru import logger
+from nonebot import get_plugin_config
 from tqdm import tqdm
-from sqlmodel import select, col, distinct, or_, and_
-
-from .models import create_tables, PlayerBP100Catch, NewScore, get_session, get_beatmap_relationship_table, \
-    beatmap_relationship_tables
-from .osu_network import get_ranking, get_bplist, map_path, download_osu
-from .osu_network.mods import calc_mods
-from .osu_network.pp import get_ss_pp
-
-
-async def crawl_bplist():
-    for page in range(1, 201):
-        data = await get_ranking("fruits", page)
-        for uid in data:
-            bplist = await get_bplist(uid, "fruits")
-            score = []
-            for (bp_position, bp) in enumerate(bplist):
-                bp: NewScore
-                mod = "".join([i.acronym for i in bp.mods if i.acronym != "CL"])
-                async with get_session() as session:
-                    existing_score = await session.exec(
-                        select(PlayerBP100Catch).where(
-                            PlayerBP100Catch.player_id == uid,
-                            PlayerBP100Catch.beatmap_id == bp.beatmap_id,
-                            PlayerBP100Catch.mod == mod
-                        )
-                    )
-                    if not existing_score.first():
-                        score.append(PlayerBP100Catch(
-                            player_id=uid,
-                            beatmap_id=bp.beatmap_id,
-                            mod=mod,
-                            bp_position=bp_position,
-                            pp=bp.pp
-                        ))
-
-            # If there are new scores to add, commit them to the database
-            if score:
-                async with get_session() as session:
-                    session.add_all(score)
-                    await session.commit()
-            # await asyncio.sleep(0.5)
-            print(f'{uid} ok')
-
-
-relationship_cache = defaultdict(lambda: defaultdict(float))
+from sqlalchemy import text
+from sqlmodel import select
+
+from .config import Config
+from .crawler import crawl_bplist
+from .graph import RelationshipBuilder, snapshot_store, write_neighbours, write_relationships, write_snapshot, write_ss_pp
+from .graph.relationship import NEIGHBOUR_K
+from .models import create_tables, PlayerBP100Catch, BeatmapNeighbourCatch, BeatmapRelationshipCatch, BeatmapSSPPCatch, \
+    get_session, get_raw_connection
+from .osu_network import beatmap_pack, get_best_scores, map_cache, prefetcher, pp_service
+from .osu_network.mods import ModSet
+
+plugin_config = get_plugin_config(Config)
+
+
+async def iter_player_bplists(session, partition_size: int = 50000):
+    """按玩家分组流式读取 PlayerBP100Catch，避免每个玩家一次查询"""
+    result = await session.stream(
+        select(PlayerBP100Catch.player_id, PlayerBP100Catch.beatmap_id, PlayerBP100Catch.mod,
+               PlayerBP100Catch.bp_position, PlayerBP100Catch.pp)
+        .order_by(PlayerBP100Catch.player_id, PlayerBP100Catch.bp_position)
+        .execution_options(yield_per=partition_size)
+    )
+    current_uid, rows = None, []
+    async for partition in result.partitions(partition_size):
+        for row in partition:
+            if row[0] != current_uid:
+                if rows:
+                    yield current_uid, rows
+                current_uid, rows = row[0], []
+            rows.append(row)
+    if rows:
+        yield current_uid, rows
+
+
+async def build_relationships(session) -> RelationshipBuilder:
+    builder = RelationshipBuilder()
+    with tqdm(desc="bp") as bar:
+        async for _, rows in iter_player_bplists(session):
+            _, beatmap_ids, mods, positions, pps = zip(*rows)
+            builder.add_player(beatmap_ids, mods, pps, positions)
+            bar.update()
+    return builder
 
 
 async def main():
@@ -54,106 +55,108 @@ async def main():
     # await crawl_bplist()
     # 计算 beatmap 之间的关系
     async with get_session() as session:
-        data = (await session.exec(select(distinct(PlayerBP100Catch.player_id)))).all()
-        for uid in tqdm(data):
-            bplist = (await session.exec(select(PlayerBP100Catch).where(PlayerBP100Catch.player_id == uid))).all()
-            for beatmap1, beatmap2 in itertools.combinations(bplist, 2):
-                if beatmap1.beatmap_id > beatmap2.beatmap_id:
-                    beatmap1, beatmap2 = beatmap2, beatmap1
-                pp_difference = abs(beatmap1.pp - beatmap2.pp)
-                bp_difference = abs(beatmap1.bp_position - beatmap2.bp_position)
-                relationship_score = (1 / (1 + pp_difference)) + (1 / (1 + bp_difference))
-                relationship_cache[(beatmap1.beatmap_id, beatmap1.mod)][
-                    (beatmap2.beatmap_id, beatmap2.mod)] += relationship_score
-                if relationship_cache[(beatmap1.beatmap_id, beatmap1.mod)][(beatmap2.beatmap_id, beatmap2.mod)] is None:
-                    raise Exception
-        for beatmap1, dic in tqdm(relationship_cache.items()):
-            for beatmap2, score in dic.items():
-                table = get_beatmap_relationship_table(beatmap1[0], beatmap2[0])
-                session.add(table(relationship_value=score,
-                                  beatmap_id1=beatmap1[0],
-                                  beatmap_id2=beatmap2[0],
-                                  beatmap_mod1=beatmap1[1],
-                                  beatmap_mod2=beatmap2[1]))
-            await session.flush()
-        await session.commit()
+        builder = await build_relationships(session)
+    async with get_raw_connection() as conn:
+        await write_relationships(conn, builder)
+        await write_neighbours(conn, builder)
+        await write_ss_pp(conn, builder.nodes)
+        await write_snapshot(conn, builder)
+    # 谱面更新后旧内容留在 pack 中成为空洞，占比超过阈值时重写回收
+    if (ratio := beatmap_pack.garbage_ratio()) > plugin_config.osu_pack_compact_ratio:
+        logger.info(f"pack 中 {ratio:.0%} 为已失效的内容，开始压缩")
+        await asyncio.to_thread(beatmap_pack.compact)
 
 
 async def get_related_map(mapid: int, mods: str):
-    res = []
-    async with (get_session() as session):
-        for table in beatmap_relationship_tables:
-            data = await session.exec(select(table).where(table.beatmap_id1 == mapid).where(table.beatmap_mod1 == mods)
-                                      .order_by(col(table.relationship_value).desc()).limit(10))
-            res.extend((i.beatmap_id2, i.beatmap_mod2, i.relationship_value) for i in data)
-    relationship_dict = defaultdict(float)
-    for i in res:
-        if relationship_dict[(i[0], i[1])] < i[2]:
-            relationship_dict[(i[0], i[1])] = i[2]
-    res = [(i, j, k) for (i, j), k in relationship_dict.items()]
-    res.sort(key=lambda x: x[2], reverse=True)
-    return res
+    if (snapshot := snapshot_store.get()) is not None:
+        return [(i, ModSet(j), k) for i, j, k in snapshot.related(mapid, ModSet.parse(mods), NEIGHBOUR_K)]
+    async with get_session() as session:
+        data = await session.exec(
+            select(BeatmapNeighbourCatch)
+            .where(BeatmapNeighbourCatch.beatmap_id == mapid, BeatmapNeighbourCatch.mod == ModSet.parse(mods))
+            .order_by(BeatmapNeighbourCatch.rank)
+        )
+        return [(i.neighbour_id, ModSet(i.neighbour_mod), i.relationship_value) for i in data]
 
 
+async def get_candidates(
+    sources: set[tuple[int, int]], mods: int, min_pp: float = 0, per_source: int = 50, limit: int = 1000
+) -> dict[tuple[int, ModSet], tuple[float, Optional[float]]]:
+    """
+    一条语句取出所有源谱面各自关系值最高的 per_source 个相关谱面，返回 {(谱面, mod): (关系值, SS pp)}
 
-async def get_related_maps(uid: int, mods: str):
-    bplist = await get_bplist(uid, "fruits")
-    res = []
-    for table in beatmap_relationship_tables:
-        conditions = [and_(table.beatmap_id1 == i.beatmap_id,
-                           table.beatmap_mod1 == "".join([j.acronym for j in i.mods if j.acronym != "CL"])) for i in
-                      bplist]
-        statement = (
-            select(table)
-            .where(or_(*conditions))
-            .order_by(col(table.relationship_value).desc())
-            .limit(100)  # 可以调整 limit 为你需要的数量
-        )
-        if mods:
-            statement = statement.where(table.beatmap_mod2 == mods)
+    源谱面以数组传入后 unnest，每个源谱面只走一次 (beatmap_id1, beatmap_mod1) 索引，
+    同一相关谱面取最大关系值，并排除源谱面自身。
+    预计算的 SS pp 不高于 min_pp 的谱面直接在 SQL 中过滤，尚未预计算的谱面 SS pp 为 None。
+    """
+    if not sources:
+        return {}
+    if (snapshot := snapshot_store.get()) is not None:
+        candidates = snapshot.candidates(sources, mods, min_pp, per_source, limit)
+        return {(i, ModSet(j)): value for (i, j), value in candidates.items()}
+    beatmap_ids, source_mods = zip(*sources)
+    mod_filter = "AND r.beatmap_mod2 = :mods " if mods else ""
+    statement = text(
+        f"SELECT c.beatmap_id2, c.beatmap_mod2, c.value, p.pp FROM ("
+        f"SELECT e.beatmap_id2, e.beatmap_mod2, max(e.relationship_value) AS value "
+        f"FROM unnest(CAST(:beatmap_ids AS int[]), CAST(:source_mods AS int[])) AS s(beatmap_id, mod) "
+        f"CROSS JOIN LATERAL (SELECT r.beatmap_id2, r.beatmap_mod2, r.relationship_value "
+        f"FROM {BeatmapRelationshipCatch.__tablename__} AS r "
+        f"WHERE r.beatmap_id1 = s.beatmap_id AND r.beatmap_mod1 = s.mod {mod_filter}"
+        f"ORDER BY r.relationship_value DESC LIMIT :per_source) AS e "
+        f"WHERE (e.beatmap_id2, e.beatmap_mod2) NOT IN "
+        f"(SELECT * FROM unnest(CAST(:beatmap_ids AS int[]), CAST(:source_mods AS int[]))) "
+        f"GROUP BY e.beatmap_id2, e.beatmap_mod2) AS c "
+        f"LEFT JOIN {BeatmapSSPPCatch.__tablename__} AS p ON p.beatmap_id = c.beatmap_id2 AND p.mod = c.beatmap_mod2 "
+        f"WHERE p.pp IS NULL OR p.pp > :min_pp "
+        f"ORDER BY c.value DESC LIMIT :limit"
+    )
+    params = {
+        "beatmap_ids": list(beatmap_ids),
+        "source_mods": [int(i) for i in source_mods],
+        "min_pp": min_pp,
+        "per_source": per_source,
+        "limit": limit,
+    }
+    if mods:
+        params["mods"] = int(mods)
+    async with get_session() as session:
+        data = await session.execute(statement, params)
+        return {(i[0], ModSet(i[1])): (i[2], i[3]) for i in data}
 
-        async with get_session() as session:
-            data = await session.exec(statement)
-            res.extend([(i.beatmap_id2, i.beatmap_mod2, i.relationship_value) for i in data])
-    relationship_dict = defaultdict(float)
-    for i in res:
-        if relationship_dict[(i[0], i[1])] < i[2]:
-            relationship_dict[(i[0], i[1])] = i[2]
-    res = [(i, j, k) for (i, j), k in relationship_dict.items()]
-    res.sort(key=lambda x: x[2], reverse=True)
-    distinct_maps = set()
+
+async def get_related_maps(uid: int, mods: str):
+    bplist = await get_best_scores(uid, "fruits")
+    played: dict[int, list[ModSet]] = {}
     for i in bplist:
-        mod = "".join([j.acronym for j in i.mods if j.acronym != "CL"])
-        if (i.beatmap_id, mod) not in distinct_maps:
-            distinct_maps.add((i.beatmap_id, mod))
-    res = [i for i in res if (i[0], i[1]) not in distinct_maps]
-    result = []
-    for i in tqdm(res):
-        if not (map_path / f"{i[0]}.osu").exists():
-            await download_osu(i[0])
-        if (map_path / f"{i[0]}.osu").exists():
-            skip_outer_loop = False  # 初始化标志变量
-            for j in bplist:
-                if j.beatmap_id == i[0]:
-                    if "HR" in "".join([k.acronym for k in j.mods]) and "DT" not in i[1]:
-                        skip_outer_loop = True  # 设置标志变量
-                        break  # 跳出内层循环
-                    if "DT" in "".join([k.acronym for k in j.mods]):
-                        skip_outer_loop = True  # 设置标志变量
-                        break  # 跳出内层循环
-                    if i[1].replace("HD", "").replace("CL", "") == "".join([k.acronym for k in j.mods]).replace("HD", "").replace("CL", ""):
-                        skip_outer_loop = True  # 设置标志变量
-                        break  # 跳出内层循环
-            if skip_outer_loop:  # 检查标志变量
-                continue  # 跳过外层循环
-            mods = calc_mods(i[1])
-            pp = get_ss_pp(str(map_path / f"{i[0]}.osu"), mods, "catch")
-            if pp > bplist[-1].pp:
-                result.append((i[0], i[1], pp))
+        played.setdefault(i.beatmap_id, []).append(i.mod)
+        # bp 中带有谱面当前的 checksum，顺便让过期的谱面缓存失效
+        map_cache.observe(i.beatmap_id, i.checksum)
+    relationship_dict = await get_candidates({(i, j) for i, mod_list in played.items() for j in mod_list},
+                                             ModSet.parse(mods), bplist[-1].pp)
+    res = sorted(((i, j, k) for (i, j), (k, _) in relationship_dict.items()), key=lambda x: x[2], reverse=True)
+    hd = ModSet.parse("HD")
+    candidates = []
+    for i in res:
+        # 跳过已经打过的谱面：bp 中有 DT 的谱面、有 HR 时非 DT 的组合、以及忽略 HD 后 mod 相同的组合
+        if any(
+            "DT" in played_mod or ("HR" in played_mod and "DT" not in i[1]) or i[1] & ~hd == played_mod & ~hd
+            for played_mod in played.get(i[0], ())
+        ):
+            continue
+        candidates.append(i)
+    result = [(i[0], i[1], relationship_dict[(i[0], i[1])][1]) for i in candidates
+              if relationship_dict[(i[0], i[1])][1] is not None]
+    # 关系图重建后才加入的谱面还没有预计算 pp，先并发下载，再在进程池中批量计算
+    missing = [i for i in candidates if relationship_dict[(i[0], i[1])][1] is None]
+    entries = await prefetcher.prefetch(i[0] for i in missing)
+    missing = [i for i in missing if entries[i[0]] is not None]
+    pps = await pp_service.ss_pp_batch([(entries[i[0]], i[1], "catch") for i in missing])
+    result.extend((i[0], i[1], pp) for i, pp in zip(missing, pps) if pp is not None and pp > bplist[-1].pp)
     result.sort(key=lambda x: x[2], reverse=True)
     final_result = []
     for i in result:
-        final_result.append((i[0], i[1], i[2], relationship_dict[(i[0], i[1])]))
+        final_result.append((i[0], i[1], i[2], relationship_dict[(i[0], i[1])][0]))
     return final_result
     # csv_file_path = f'{uid}.csv'
     #
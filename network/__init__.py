@@ -1,4 +1,6 @@
-from .auto_retry import auto_retry
-from .first_response import get_first_response
+from .auto_retry import CircuitOpenError, auto_retry
+from .client import get_client, close_client
+from .first_response import NotFoundError, get_first_response
+from .rate_limit import Priority, RateLimiter, request_priority, use_priority
 
-__all__ = ["auto_retry", "get_first_response"]
+__all__ = ["CircuitOpenError", "NotFoundError", "auto_retry", "get_client", "close_client", "get_first_response", "RateLimiter", "Priority", "request_priority", "use_priority"]
@@ -1,20 +1,197 @@
+import asyncio
+import random
+import time
+from collections import defaultdict
+from email.utils import parsedate_to_datetime
 from functools import wraps
-from typing import TypeVar, Callable
-from typing_extensions import ParamSpec
+from typing import TypeVar, Callable, Optional
+from urllib.parse import urlsplit
+
+from httpx import Response, TransportError
 from loguru import logger
+from nonebot import get_plugin_config
+from typing_extensions import ParamSpec
+
+from ..config import Config
 
 T = TypeVar("T")
 P = ParamSpec("P")
 
+plugin_config = get_plugin_config(Config)
+# 这些状态码说明服务端暂时不可用，值得重试；其他 4xx 重试也不会成功，直接返回给调用方
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(TransportError):
+    """host 熔断期间直接失败，没有发出请求"""
+
+
+class RetryBudget:
+    """
+    全局重试预算，每个原始请求存入 ratio 个令牌，每次重试取出一个
+
+    另按 min_per_second 补充少量令牌，请求很少时也能重试。
+    故障期间重试带来的额外请求不超过原始请求的 ratio 倍。
+    """
+
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 1, max_tokens: float = 20):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._updated = time.monotonic()
+
+    def _refill(self, amount: float = 0):
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.min_per_second + amount)
+        self._updated = now
+
+    def deposit(self):
+        self._refill(self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill()
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class CircuitBreaker:
+    """
+    单个 host 的熔断器
+
+    连续失败 failures 次后打开，reset_timeout 秒内的请求直接失败；
+    之后放行一个探测请求，成功则关闭，失败则继续打开。
+    """
+
+    def __init__(self, failures: int = 5, reset_timeout: float = 30):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self._count = 0
+        self._opened_at: Optional[float] = None
+        self._probe_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        if self._opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self._opened_at < self.reset_timeout:
+            return False
+        # 探测请求被取消或出错而没有结果时，过 reset_timeout 后允许再次探测
+        if self._probe_at is not None and now - self._probe_at < self.reset_timeout:
+            return False
+        self._probe_at = now
+        return True
+
+    def record(self, ok: bool):
+        if ok:
+            self._count = 0
+            self._opened_at = None
+        else:
+            self._count += 1
+            if self._opened_at is not None or self._count >= self.failures:
+                self._opened_at = time.monotonic()
+        self._probe_at = None
+
+
+class RetryPolicy:
+    """指数退避加全抖动，等待时间在 [0, min(cap, base * 2^n)] 内随机"""
+
+    def __init__(self, attempts: int = 3, base: float = 0.5, cap: float = 10, deadline: float = 60):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        # 从第一次请求开始计算的总时长上限，超过后不再重试
+        self.deadline = deadline
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+retry_policy = RetryPolicy(plugin_config.osu_retry_attempts, deadline=plugin_config.osu_retry_deadline)
+retry_budget = RetryBudget(plugin_config.osu_retry_budget_ratio)
+circuit_breakers: defaultdict[str, CircuitBreaker] = defaultdict(
+    lambda: CircuitBreaker(plugin_config.osu_circuit_failures, plugin_config.osu_circuit_reset)
+)
+
+
+def retry_after(response: Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def request_key(func: Callable, args: tuple, kwargs: dict) -> Optional[str]:
+    """第一个参数是 URL 时按 host 熔断；否则返回 None，由被装饰的函数自己按实际请求的 host 熔断"""
+    url = kwargs.get("url", args[0] if args else None)
+    if isinstance(url, str) and "://" in url:
+        return urlsplit(url).netloc
+    return None
+
 
 def auto_retry(func: Callable[P, T]) -> Callable[P, T]:
+    """
+    按错误类型重试：网络错误、超时和 RETRY_STATUS 中的状态码会退避后重试，其他状态码原样返回
+
+    host 熔断时抛出 CircuitOpenError；重试受全局预算限制。最终失败时抛出最后一次的 TransportError，
+    最后一次的可用响应（如 429）则原样返回。其他异常不重试，直接抛给调用方。
+    """
+
     @wraps(func)
     async def wrapper(*args, **kwargs):
-        for i in range(5):
+        key = request_key(func, args, kwargs)
+        breaker = circuit_breakers[key] if key is not None else None
+        name = key or func.__qualname__
+        retry_budget.deposit()
+        start = time.monotonic()
+        for attempt in range(retry_policy.attempts + 1):
+            if breaker is not None and not breaker.allow():
+                raise CircuitOpenError(f"{name} 已熔断，暂停请求")
+            error, delay_hint = None, None
             try:
-                return await func(*args, **kwargs)
-            except Exception as e:
-                logger.warning(f"{e} | Retrying... {i + 1}/5")
-        logger.error("多次重试失败，请检查网络连接")
+                result = await func(*args, **kwargs)
+            except TransportError as e:
+                if breaker is not None:
+                    breaker.record(False)
+                error = e
+                logger.warning(f"{name} 请求失败: {e!r} | {attempt + 1}/{retry_policy.attempts + 1}")
+            else:
+                if not isinstance(result, Response) or result.status_code not in RETRY_STATUS:
+                    if breaker is not None:
+                        breaker.record(True)
+                    return result
+                # 429 说明服务正常只是限流，不计入熔断
+                if breaker is not None:
+                    breaker.record(result.status_code == 429)
+                delay_hint = retry_after(result)
+                logger.warning(f"{name} 返回 {result.status_code} | {attempt + 1}/{retry_policy.attempts + 1}")
+            if attempt == retry_policy.attempts:
+                break
+            delay = retry_policy.backoff(attempt, delay_hint)
+            if time.monotonic() - start + delay > retry_policy.deadline:
+                logger.warning(f"{name} 超过重试时限，放弃重试")
+                break
+            if not retry_budget.withdraw():
+                logger.warning(f"重试预算已用完，放弃重试 {name}")
+                break
+            await asyncio.sleep(delay)
+        logger.error(f"{name} 多次重试失败，请检查网络连接")
+        if error is not None:
+            raise error
+        return result
 
     return wrapper
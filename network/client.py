@@ -0,0 +1,41 @@
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from typing import Optional
+
+from httpx import AsyncClient, Limits, Timeout
+from nonebot import get_driver, get_plugin_config
+
+from ..config import Config
+
+plugin_config = get_plugin_config(Config)
+_client: Optional[AsyncClient] = None
+
+
+def get_client() -> AsyncClient:
+    """插件内共享的 HTTP 客户端，复用连接池避免每次请求重新握手"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = AsyncClient(
+            http2=plugin_config.osu_http2,
+            limits=Limits(
+                max_connections=plugin_config.osu_http_max_connections,
+                max_keepalive_connections=plugin_config.osu_http_max_keepalive,
+            ),
+            timeout=Timeout(plugin_config.osu_http_timeout, connect=plugin_config.osu_http_connect_timeout),
+            proxy=plugin_config.osu_proxy,
+            follow_redirects=True,
+            # 不保存响应中的 cookie，避免网页接口的会话混入 API 请求
+            cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+driver = get_driver()
+driver.on_startup(get_client)
+driver.on_shutdown(close_client)
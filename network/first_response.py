@@ -1,23 +1,122 @@
 import asyncio
-from httpx import AsyncClient
+import time
+from collections import defaultdict
+from typing import Optional
+from urllib.parse import urlsplit
 
+from httpx import AsyncClient, TransportError
 
-async def fetch_url(client: AsyncClient, url):
+from .auto_retry import circuit_breakers
+from .client import get_client
+
+
+class NotFoundError(Exception):
+    """所有镜像都返回 404，重试也不会成功"""
+
+
+class MirrorStats:
+    """单个镜像的延迟与错误率，延迟估计方式同 TCP RTO（平滑均值 + 4 倍平均偏差）"""
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.latency: Optional[float] = None
+        self.deviation = 0.0
+        self.error_rate = 0.0
+
+    def observe(self, latency: float, ok: bool):
+        self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+        if not ok:
+            return
+        if self.latency is None:
+            self.latency, self.deviation = latency, latency / 2
+        else:
+            self.deviation += self.alpha * (abs(latency - self.latency) - self.deviation)
+            self.latency += self.alpha * (latency - self.latency)
+
+    def observe_cancelled(self, elapsed: float):
+        # 被取消说明实际延迟至少为 elapsed，只用它把偏低的估计往上调
+        if self.latency is None:
+            # 总是输给其他镜像的慢镜像永远不会成功一次，没有这个下界它会一直排在最前面
+            self.latency, self.deviation = elapsed, elapsed / 2
+        elif elapsed > self.latency:
+            self.latency += self.alpha * (elapsed - self.latency)
+
+    def score(self) -> float:
+        # 没有数据的镜像优先尝试一次，才能知道它快不快
+        latency = 0.0 if self.latency is None else self.latency
+        return latency * (1 + 4 * self.error_rate) + self.error_rate
+
+    def hedge_delay(self) -> float:
+        """等待该镜像多久没有响应时启动下一个镜像"""
+        if self.latency is None:
+            return 1.0
+        return min(max(self.latency + 4 * self.deviation, 0.1), 10.0)
+
+
+mirror_stats: defaultdict[str, MirrorStats] = defaultdict(MirrorStats)
+
+
+def mirror_host(url: str) -> str:
+    return urlsplit(url).netloc
+
+
+async def fetch_url(client: AsyncClient, url) -> tuple[Optional[bytes], bool]:
+    """返回 (内容, 是否为 404)，请求失败或镜像已熔断时内容为 None"""
+    host = mirror_host(url)
+    stats = mirror_stats[host]
+    breaker = circuit_breakers[host]
+    if not breaker.allow():
+        return None, False
+    start = time.monotonic()
     try:
         response = await client.get(url)
-        return response
-    except Exception:
-        return None
+    except TransportError:
+        stats.observe(time.monotonic() - start, False)
+        breaker.record(False)
+        return None, False
+    ok = response.status_code == 200 and bool(response.content)
+    stats.observe(time.monotonic() - start, ok)
+    # 404 等 4xx 说明镜像本身正常，只是没有这个谱面，不计入熔断
+    breaker.record(response.status_code < 500)
+    return (response.content if ok else None), response.status_code == 404
 
 
-async def get_first_response(urls: list[str]):
-    async with AsyncClient(follow_redirects=True) as client:
-        tasks = [asyncio.create_task(fetch_url(client, url)) for url in urls]
-        while tasks:
-            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+async def get_first_response(urls: list[str]) -> Optional[bytes]:
+    """
+    对冲请求多个镜像
+
+    按近期延迟和错误率排序，先请求最好的镜像；超过其自适应等待时间仍无响应或请求失败时才请求下一个，
+    任一镜像成功后取消其余请求。已熔断的镜像直接跳过。
+    全部失败时返回 None；所有镜像都返回 404 时抛出 NotFoundError。
+    """
+    client = get_client()
+    queue = sorted(urls, key=lambda url: mirror_stats[mirror_host(url)].score())
+    pending: set[asyncio.Task] = set()
+    started: dict[asyncio.Task, tuple[str, float]] = {}
+    not_found = 0
+    try:
+        while queue or pending:
+            timeout = None
+            if queue:
+                url = queue.pop(0)
+                task = asyncio.create_task(fetch_url(client, url))
+                pending.add(task)
+                started[task] = (url, time.monotonic())
+                if queue:
+                    timeout = mirror_stats[mirror_host(url)].hedge_delay()
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
             for task in done:
-                response = task.result()
-                if response is not None and response.status_code == 200:
-                    return response.content
-            tasks = [task for task in tasks if not task.done()]
+                content, missing = task.result()
+                if content is not None:
+                    return content
+                not_found += missing
+        if urls and not_found == len(urls):
+            raise NotFoundError(urls)
         return None
+    finally:
+        now = time.monotonic()
+        for task in pending:
+            task.cancel()
+            # 在这里而不是在任务内记录，紧接着的下一次请求排序时就能用上
+            url, start = started[task]
+            mirror_stats[mirror_host(url)].observe_cancelled(now - start)
@@ -0,0 +1,116 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Optional
+
+
+class Priority(IntEnum):
+    """数值越小越先放行"""
+
+    INTERACTIVE = 0
+    BATCH = 1
+
+
+# 当前任务发出的请求的优先级，爬虫等批量任务在入口处设置为 BATCH，asyncio 任务创建时会继承
+request_priority: ContextVar[Priority] = ContextVar("request_priority", default=Priority.INTERACTIVE)
+
+
+@contextmanager
+def use_priority(priority: Priority):
+    token = request_priority.set(priority)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+class RateLimiter:
+    """
+    令牌桶限速，所有调用方共享同一个桶
+
+    等待中的请求按优先级放行，同一优先级按到达顺序；
+    桶中令牌不超过 reserve 个时只放行交互请求，批量任务不会把突发额度用光。
+    """
+
+    def __init__(self, rate: float, burst: int = 1, reserve: int = 0):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.reserve = min(max(reserve, 0), self.burst - 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self.queue_depth = {i: 0 for i in Priority}
+        self.throttle_time = {i: 0.0 for i in Priority}
+        self.acquired = {i: 0 for i in Priority}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _required(self, priority: Priority) -> float:
+        return 1 if priority == Priority.INTERACTIVE else 1 + self.reserve
+
+    async def acquire(self, priority: Optional[Priority] = None):
+        priority = request_priority.get() if priority is None else priority
+        self.acquired[priority] += 1
+        self._refill()
+        ahead = self._waiters and self._waiters[0][0] <= priority
+        if not ahead and self._tokens >= self._required(priority):
+            self._tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self.queue_depth[priority] += 1
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        else:
+            # 新来的请求可能优先级更高，唤醒正在按队首计算等待时间的调度任务
+            self._wakeup.set()
+        start = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not future.done() or future.cancelled():
+                self.queue_depth[priority] -= 1
+            raise
+        finally:
+            self.throttle_time[priority] += time.monotonic() - start
+
+    async def _dispatch(self):
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.cancelled():
+                heapq.heappop(self._waiters)
+                continue
+            self._refill()
+            required = self._required(priority)
+            if self._tokens < required:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), (required - self._tokens) / self.rate)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._waiters)
+            self._tokens -= 1
+            self.queue_depth[priority] -= 1
+            future.set_result(None)
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """各优先级的排队数、累计等待秒数和请求数"""
+        return {
+            i.name.lower(): {
+                "queue_depth": self.queue_depth[i],
+                "throttle_time": round(self.throttle_time[i], 3),
+                "acquired": self.acquired[i],
+            }
+            for i in Priority
+        }
@@ -1,24 +1,37 @@
 from enum import Enum
 from pathlib import Path
-from httpx import AsyncClient, Response, NetworkError
+from httpx import Response, NetworkError, TransportError
 from typing import Union, Optional
-from expiringdict import ExpiringDict
 
 from ..config import Config
-from ..models import Beatmap, NewScore
+from ..models import Beatmap, NewScore, RankingEntry
 from loguru import logger
-from ..network import auto_retry, get_first_response
-from nonebot import get_plugin_config
+from ..network import auto_retry, get_client, get_first_response, RateLimiter
+from nonebot import get_driver, get_plugin_config
+import orjson
+from .map_cache import BeatmapCache
+from .pack import BeatmapPack, PackEntry
+from .pp import PPService
+from .prefetch import OsuPrefetcher
+from .scores import BestScore, decode_best_scores
+from .token import TokenManager
 
 
 plugin_config = get_plugin_config(Config)
 api = "https://osu.ppy.sh/api/v2"
 key = plugin_config.osu_key
 client_id = plugin_config.osu_client
-cache = ExpiringDict(max_len=1, max_age_seconds=86400)
-proxy = None
+token_manager = TokenManager(client_id, key)
+# 旧版每个谱面一个 .osu 文件的目录，只读，其中的谱面第一次用到时导入 beatmap_pack
 map_path = Path() / "data" / "osu" / "map"
-map_path.mkdir(parents=True, exist_ok=True)
+beatmap_pack = BeatmapPack(Path() / "data" / "osu" / "pack", plugin_config.osu_pack_level)
+api_limiter = RateLimiter(plugin_config.osu_api_rate, plugin_config.osu_api_burst, plugin_config.osu_api_interactive_reserve)
+pp_service = PPService(beatmap_pack.pack_path, plugin_config.osu_pp_workers, plugin_config.osu_pp_cache_size)
+driver = get_driver()
+driver.on_startup(pp_service.start)
+driver.on_shutdown(pp_service.close)
+driver.on_shutdown(beatmap_pack.close)
+driver.on_shutdown(token_manager.close)
 
 
 class TokenExpireError(NetworkError):
@@ -33,49 +46,37 @@ class OsuGameMode(Enum):
 
 
 async def renew_token():
-    url = "https://osu.ppy.sh/oauth/token"
-    async with AsyncClient(timeout=100) as client:
-        client: AsyncClient
-        req = await client.post(
-            url,
-            json={
-                "client_id": f"{client_id}",
-                "client_secret": f"{key}",
-                "grant_type": "client_credentials",
-                "scope": "public",
-            },
-        )
-    if req.status_code == 200:
-        osu_token = req.json()
-        cache.update({"token": osu_token["access_token"]})
-    else:
-        logger.error(f"更新OSU token出错 错误{req.status_code}")
+    return await token_manager.renew()
 
 
 async def get_header():
-    token = cache.get("token")
-    if not token:
-        await renew_token()
-        token = cache.get("token")
+    token = await token_manager.get()
     return {"Authorization": f"Bearer {token}", "x-api-version": "20220705"}
 
 
+async def api_get(url: str, params: Optional[dict] = None) -> Response:
+    """带 token 的 GET，遇到 401 时作废当前 token 并重试一次；网络错误或熔断时抛出 TransportError"""
+    header = await get_header()
+    req = await safe_async_get(url, headers=header, params=params)
+    if req.status_code == 401:
+        token_manager.invalidate(header["Authorization"].removeprefix("Bearer "))
+        req = await safe_async_get(url, headers=await get_header(), params=params)
+    return req
+
+
 @auto_retry
 async def safe_async_get(
     url, headers: Optional[dict] = None, params: Optional[dict] = None
 ) -> Response:
-    async with AsyncClient(timeout=100, proxies=proxy, follow_redirects=True) as client:
-        client: AsyncClient
-        req = await client.get(url, headers=headers, params=params)
-    return req
+    # 每次重试都会重新排队，重试同样计入配额
+    await api_limiter.acquire()
+    return await get_client().get(url, headers=headers, params=params)
 
 
 @auto_retry
 async def safe_async_post(url, headers=None, data=None, json=None) -> Response:
-    async with AsyncClient(timeout=100, proxies=proxy) as client:
-        client: AsyncClient
-        req = await client.post(url, headers=headers, data=data, json=json)
-    return req
+    await api_limiter.acquire()
+    return await get_client().post(url, headers=headers, data=data, json=json)
 
 
 async def osu_api(
@@ -113,11 +114,11 @@ async def osu_api(
 
 
 async def get_user_info(url: str) -> Union[dict, str]:
-    header = await get_header()
-    req = await safe_async_get(url, headers=header)
-    if not req:
+    try:
+        req = await api_get(url)
+    except TransportError:
         return "api请求失败，请稍后再试"
-    elif req.status_code == 404:
+    if req.status_code == 404:
         return "未找到该玩家，请确认玩家ID是否正确，有无多余或缺少的空格"
     elif req.status_code == 200:
         return req.json()
@@ -126,14 +127,15 @@ async def get_user_info(url: str) -> Union[dict, str]:
 
 
 async def api_info(project: str, url: str) -> Union[dict, str]:
-    if project == "mapinfo" or project == "PPCalc":
-        header = {
-            "user-agent": "Mozilla/5.0 (Windows NT 10.0; WOW64) Chrome/78.0.3904.108"
-        }
-    else:
-        header = await get_header()
-    req = await safe_async_get(url, headers=header)
-    if not req:
+    try:
+        if project == "mapinfo" or project == "PPCalc":
+            header = {
+                "user-agent": "Mozilla/5.0 (Windows NT 10.0; WOW64) Chrome/78.0.3904.108"
+            }
+            req = await safe_async_get(url, headers=header)
+        else:
+            req = await api_get(url)
+    except TransportError:
         return "api请求失败，请稍后再试"
     if req.status_code >= 400:
         if project == "info" or project == "bind":
@@ -159,41 +161,64 @@ def calc_songlen(length: int) -> str:
 
 
 @auto_retry
-async def download_osu(map_id):
+async def download_osu(map_id) -> bytes:
+    """各镜像按 host 各自熔断；所有镜像都没有该谱面时抛出 NotFoundError，不会重试"""
     url = [f"https://osu.ppy.sh/osu/{map_id}", f"https://api.osu.direct/osu/{map_id}"]
     logger.info(f"开始下载谱面: <{map_id}>")
     if req := await get_first_response(url):
-        filename = f"{map_id}.osu"
-        filepath = map_path / filename
-        with open(filepath, "wb") as f:
-            f.write(req)
-        return filepath
+        return req
     else:
         raise NetworkError(f"下载 map_id {map_id} 出错，请稍后再试")
 
 
-async def get_map_info(map_id) -> Beatmap:
+async def fetch_map_info(map_id: int) -> dict:
     url = f"{api}/beatmaps/{map_id}"
-    header = await get_header()
-    req = await safe_async_get(url, headers=header)
-    if not req or req.status_code >= 400:
+    req = await api_get(url)
+    if req.status_code >= 400:
         raise NetworkError(f"获取地图信息 {map_id} 时出错")
-    return Beatmap(**req.json())
+    return orjson.loads(req.content)
+
+
+map_cache = BeatmapCache(
+    Path() / "data" / "osu" / "beatmap_cache.db",
+    fetch_map_info,
+    plugin_config.osu_map_cache_ttl,
+    plugin_config.osu_map_cache_size,
+)
+driver.on_shutdown(map_cache.close)
+prefetcher = OsuPrefetcher(
+    download_osu, beatmap_pack, map_path, plugin_config.osu_prefetch_concurrency, map_cache.checksum
+)
+
+
+async def get_map_info(map_id) -> Beatmap:
+    """谱面信息，优先读取缓存，稳定状态下不需要请求 API"""
+    return await map_cache.get(int(map_id))
 
 
-async def get_ranking(mode: str, page=1):
+async def get_ranking(mode: str, page=1) -> list[RankingEntry]:
     url = f"{api}/rankings/{mode}/performance"
-    header = await get_header()
-    req = await safe_async_get(url, headers=header, params={"cursor[page]": page})
-    if not req or req.status_code >= 400:
+    req = await api_get(url, params={"cursor[page]": page})
+    if req.status_code >= 400:
         raise NetworkError
-    return [i['user']['id'] for i in req.json()['ranking']]
+    return [
+        RankingEntry(user_id=i['user']['id'], pp=i['pp'], play_count=i['play_count'])
+        for i in req.json()['ranking']
+    ]
 
 
 async def get_bplist(uid: int, mode: str):
     url = f"{api}/users/{uid}/scores/best?mode={mode}&limit=100"
-    header = await get_header()
-    req = await safe_async_get(url, headers=header)
+    req = await api_get(url)
+    req.raise_for_status()
     return [NewScore(**i) for i in req.json()]
 
 
+async def get_best_scores(uid: int, mode: str) -> list[BestScore]:
+    """只取 beatmap_id、mods、pp 的 bp 列表，比 get_bplist 快得多"""
+    url = f"{api}/users/{uid}/scores/best?mode={mode}&limit=100"
+    req = await api_get(url)
+    req.raise_for_status()
+    return decode_best_scores(req.content)
+
+
@@ -0,0 +1,149 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Iterable, Optional
+
+import orjson
+
+from ..models import Beatmap
+
+# 这些状态的谱面内容不会再变化，缓存到 checksum 改变为止
+PERMANENT_STATUS = {"ranked", "approved", "loved"}
+
+
+class BeatmapCache:
+    """
+    谱面元数据缓存，内存 LRU 在前，sqlite 持久化在后，重启后不需要重新请求
+
+    ranked、approved、loved 谱面一直有效，直到从其他接口（如 bp 列表）观察到新的 checksum；
+    其余状态的谱面只缓存 ttl 秒。同一谱面的并发请求共享一次 API 请求。
+    observe_many 观察到的 checksum 同时写入 sqlite，离线重建等其他进程也能据此发现谱面更新。
+    """
+
+    def __init__(
+        self, path: Path, fetch: Callable[[int], Awaitable[dict]], ttl: float = 1800, size: int = 1024
+    ):
+        self.path = path
+        self.fetch = fetch
+        self.ttl = ttl
+        self.size = size
+        self._memory: OrderedDict[int, tuple[float, Beatmap]] = OrderedDict()
+        self._observed: OrderedDict[int, str] = OrderedDict()
+        self._inflight: dict[int, asyncio.Task] = {}
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS beatmap (map_id INTEGER PRIMARY KEY, status TEXT, checksum TEXT, "
+                "fetched_at REAL, data BLOB)"
+            )
+            self._db.execute("CREATE TABLE IF NOT EXISTS observed (map_id INTEGER PRIMARY KEY, checksum TEXT)")
+            self._db.commit()
+        return self._db
+
+    def _load(self, map_id: int) -> Optional[tuple[float, bytes, Optional[str]]]:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT b.fetched_at, b.data, o.checksum FROM beatmap AS b LEFT JOIN observed AS o USING (map_id) "
+                "WHERE b.map_id = ?",
+                (map_id,),
+            ).fetchone()
+
+    def _save_observed(self, items: list[tuple[int, str]]):
+        with self._lock:
+            db = self._connect()
+            db.executemany("INSERT OR REPLACE INTO observed (map_id, checksum) VALUES (?, ?)", items)
+            db.commit()
+
+    def _save(self, map_id: int, status: str, checksum: Optional[str], fetched_at: float, data: bytes):
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO beatmap (map_id, status, checksum, fetched_at, data) VALUES (?, ?, ?, ?, ?)",
+                (map_id, status, checksum, fetched_at, data),
+            )
+            # 刚请求到的就是最新内容，之前的观察记录已无用
+            db.execute("DELETE FROM observed WHERE map_id = ?", (map_id,))
+            db.commit()
+
+    def _fresh(self, fetched_at: float, beatmap: Beatmap, observed: Optional[str] = None) -> bool:
+        observed = self._observed.get(beatmap.id, observed)
+        if observed is not None and beatmap.checksum is not None and observed != beatmap.checksum:
+            return False
+        return beatmap.status in PERMANENT_STATUS or time.time() - fetched_at < self.ttl
+
+    def _remember(self, map_id: int, fetched_at: float, beatmap: Beatmap):
+        self._memory[map_id] = (fetched_at, beatmap)
+        self._memory.move_to_end(map_id)
+        while len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+
+    def observe(self, map_id: int, checksum: Optional[str]):
+        """记录从其他接口看到的最新 checksum，与缓存不一致时下次读取会重新请求"""
+        if checksum is None:
+            return
+        self._observed[map_id] = checksum
+        self._observed.move_to_end(map_id)
+        while len(self._observed) > self.size * 16:
+            self._observed.popitem(last=False)
+
+    async def observe_many(self, items: Iterable[tuple[int, Optional[str]]]):
+        """同 observe，并把与缓存不一致的 checksum 写入 sqlite"""
+        changed = []
+        for map_id, checksum in items:
+            if checksum is None:
+                continue
+            self.observe(map_id, checksum)
+            if (item := self._memory.get(map_id)) is None or item[1].checksum != checksum:
+                changed.append((map_id, checksum))
+        if changed:
+            await asyncio.to_thread(self._save_observed, changed)
+
+    def checksum(self, map_id: int) -> Optional[str]:
+        """不发出任何请求，只根据已知信息返回谱面当前的 checksum"""
+        if (checksum := self._observed.get(map_id)) is not None:
+            return checksum
+        if (item := self._memory.get(map_id)) is not None:
+            return item[1].checksum
+        return None
+
+    async def get(self, map_id: int) -> Beatmap:
+        if (item := self._memory.get(map_id)) is not None and self._fresh(*item):
+            self._memory.move_to_end(map_id)
+            return item[1]
+        task = self._inflight.get(map_id)
+        if task is None:
+            task = asyncio.create_task(self._get(map_id))
+            self._inflight[map_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(map_id, None))
+        return await asyncio.shield(task)
+
+    async def _get(self, map_id: int) -> Beatmap:
+        if (row := await asyncio.to_thread(self._load, map_id)) is not None:
+            fetched_at, data, observed = row
+            beatmap = Beatmap(**orjson.loads(data))
+            if self._fresh(fetched_at, beatmap, observed):
+                self._remember(map_id, fetched_at, beatmap)
+                return beatmap
+        data = await self.fetch(map_id)
+        beatmap = Beatmap(**data)
+        fetched_at = time.time()
+        self._observed.pop(map_id, None)
+        self._remember(map_id, fetched_at, beatmap)
+        await asyncio.to_thread(
+            self._save, map_id, beatmap.status, beatmap.checksum, fetched_at, orjson.dumps(data)
+        )
+        return beatmap
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -1,3 +1,5 @@
+from typing import Iterable
+
 mods_dic = {
     "CL": 0,
     "NO": 0,
@@ -47,3 +49,46 @@ def mods2list(args: str) -> list:
     args = args.replace(" ", "").replace(",", "").replace("，", "")
     args = args.upper()
     return [args[i : i + 2] for i in range(0, len(args), 2)]
+
+
+class ModSet(int):
+    """
+    按 mods_dic 编码的 mod 位掩码，数据库中以整数列存储
+
+    CL、NO 以及 mods_dic 中没有的 mod 编码为 0。
+    """
+
+    def __new__(cls, value: int = 0):
+        return super().__new__(cls, value)
+
+    @classmethod
+    def from_acronyms(cls, acronyms: Iterable[str]) -> "ModSet":
+        value = 0
+        for acronym in acronyms:
+            value |= mods_dic.get(acronym, 0)
+        return cls(value)
+
+    @classmethod
+    def parse(cls, mods: str) -> "ModSet":
+        """解析 "HDHR" 这样的拼接字符串"""
+        return cls.from_acronyms(mods2list(mods))
+
+    def __contains__(self, acronym: str) -> bool:
+        bit = mods_dic.get(acronym, 0)
+        return bit != 0 and self & bit == bit
+
+    def without(self, *acronyms: str) -> "ModSet":
+        return ModSet(self & ~ModSet.from_acronyms(acronyms))
+
+    @property
+    def acronyms(self) -> list[str]:
+        return [acronym for acronym, bit in mod_bits if self & bit]
+
+    def __str__(self) -> str:
+        return "".join(self.acronyms)
+
+    def __repr__(self) -> str:
+        return f"ModSet({str(self) or 'NM'})"
+
+
+mod_bits = [(acronym, bit) for acronym, bit in mods_dic.items() if bit]
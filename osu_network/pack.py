@@ -0,0 +1,222 @@
+import hashlib
+import mmap
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import zstandard
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 没有 fcntl，只能保证单进程写入
+    fcntl = None
+
+
+class PackEntry(NamedTuple):
+    map_id: int
+    offset: int
+    length: int
+    """压缩后的字节数"""
+    checksum: str
+    """解压后内容的 md5，与 Beatmap.checksum 一致"""
+
+
+class PackReader:
+    """只读打开 pack 文件，用 mmap 按偏移读取；文件追加后或被 compact 替换后重新映射"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = None
+        self._map: Optional[mmap.mmap] = None
+        self._lock = threading.Lock()
+
+    def _mapped(self, end: int) -> mmap.mmap:
+        if self._file is not None and os.fstat(self._file.fileno()).st_ino != os.stat(self.path).st_ino:
+            self._close()
+        if self._map is None or len(self._map) < end:
+            if self._map is not None:
+                self._map.close()
+            if self._file is None:
+                self._file = open(self.path, "rb")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def raw(self, entry: PackEntry) -> bytes:
+        with self._lock:
+            return self._mapped(entry.offset + entry.length)[entry.offset:entry.offset + entry.length]
+
+    def read(self, entry: PackEntry) -> bytes:
+        """读取并解压，数据损坏时抛出 zstandard.ZstdError，内容与 md5 不一致时抛出 ValueError"""
+        content = zstandard.ZstdDecompressor().decompress(self.raw(entry))
+        if hashlib.md5(content).hexdigest() != entry.checksum:
+            raise ValueError(f"谱面 {entry.map_id} 的内容与 md5 不一致")
+        return content
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+_readers: dict[str, PackReader] = {}
+
+
+def read_entry(path: str, entry: PackEntry) -> bytes:
+    """在 pp 计算的工作进程中读取谱面，每个进程各自打开一个 PackReader"""
+    if (reader := _readers.get(path)) is None:
+        reader = _readers[path] = PackReader(Path(path))
+    return reader.read(entry)
+
+
+class BeatmapPack:
+    """
+    .osu 文件的压缩存储：zstd 压缩后追加到单个 pack 文件，sqlite 记录每个谱面的偏移、长度和 md5
+
+    同一谱面更新时追加新内容并改写索引，旧内容成为空洞，由 compact() 回收。
+    追加和 compact 都持有 pack 文件的 flock，插件和离线重建可以同时写入；
+    其他进程改写索引后，下次读取索引时重新加载。
+    索引在数据写入 pack 之后才更新；断电等原因损坏的内容校验不通过，由 discard() 删除后重新下载。
+    """
+
+    def __init__(self, directory: Path, level: int = 10):
+        self.directory = directory
+        self.level = level
+        self.pack_path = directory / "beatmaps.pack"
+        self.index_path = directory / "beatmaps.sqlite"
+        self._entries: Optional[dict[int, PackEntry]] = None
+        self._data_version: Optional[int] = None
+        self._db: Optional[sqlite3.Connection] = None
+        self._reader = PackReader(self.pack_path)
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self.pack_path.touch(exist_ok=True)
+            self._db = sqlite3.connect(self.index_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS pack (map_id INTEGER PRIMARY KEY, offset INTEGER, length INTEGER, "
+                "checksum TEXT)"
+            )
+            self._db.commit()
+        return self._db
+
+    def _load(self) -> dict[int, PackEntry]:
+        """需持有 _lock；data_version 只在其他连接提交后变化，据此判断索引是否被其他进程改写"""
+        db = self._connect()
+        data_version = db.execute("PRAGMA data_version").fetchone()[0]
+        if self._entries is None or data_version != self._data_version:
+            rows = db.execute("SELECT map_id, offset, length, checksum FROM pack").fetchall()
+            self._entries = {i[0]: PackEntry(*i) for i in rows}
+            self._data_version = data_version
+        return self._entries
+
+    @property
+    def entries(self) -> dict[int, PackEntry]:
+        with self._lock:
+            return self._load()
+
+    def get(self, map_id: int) -> Optional[PackEntry]:
+        return self.entries.get(map_id)
+
+    def read(self, entry: PackEntry) -> Optional[bytes]:
+        """读取谱面内容，数据损坏或与记录的 md5 不一致时返回 None"""
+        try:
+            return self._reader.read(entry)
+        except (zstandard.ZstdError, ValueError):
+            return None
+
+    def verify(self, entry: PackEntry) -> bool:
+        return self.read(entry) is not None
+
+    def discard(self, entry: PackEntry):
+        """删除损坏的索引记录；索引已指向其他内容（如其他进程刚写入的新版本）时不删除"""
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "DELETE FROM pack WHERE map_id = ? AND offset = ? AND length = ? AND checksum = ?", entry
+            )
+            db.commit()
+            if self._entries is not None and self._entries.get(entry.map_id) == entry:
+                del self._entries[entry.map_id]
+
+    def _open_locked(self, mode: str):
+        """打开 pack 文件并加排他锁；等锁期间文件被其他进程 compact 替换时重新打开"""
+        while True:
+            f = open(self.pack_path, mode)
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            if os.fstat(f.fileno()).st_ino == os.stat(self.pack_path).st_ino:
+                return f
+            f.close()
+
+    def put(self, map_id: int, content: bytes) -> PackEntry:
+        data = zstandard.ZstdCompressor(level=self.level, write_checksum=True).compress(content)
+        checksum = hashlib.md5(content).hexdigest()
+        with self._lock:
+            db = self._connect()
+            # 索引提交后才释放文件锁，其他进程的 compact 不会漏掉这段内容
+            with self._open_locked("ab") as f:
+                f.write(data)
+                f.flush()
+                entry = PackEntry(map_id, f.tell() - len(data), len(data), checksum)
+                db.execute(
+                    "INSERT OR REPLACE INTO pack (map_id, offset, length, checksum) VALUES (?, ?, ?, ?)", entry
+                )
+                db.commit()
+            self._load()[map_id] = entry
+        return entry
+
+    def garbage_ratio(self) -> float:
+        size = self.pack_path.stat().st_size if self.pack_path.exists() else 0
+        if not size:
+            return 0.0
+        return 1 - sum(i.length for i in self.entries.values()) / size
+
+    def compact(self):
+        """只保留索引引用的内容重写 pack 文件，重写期间其他进程的写入等待文件锁"""
+        tmp_path = self.pack_path.with_suffix(".tmp")
+        with self._lock, self._open_locked("rb"):
+            entries = self._load()
+            reader = PackReader(self.pack_path)
+            compacted = {}
+            with open(tmp_path, "wb") as f:
+                for map_id, entry in entries.items():
+                    data = reader.raw(entry)
+                    compacted[map_id] = PackEntry(map_id, f.tell(), entry.length, entry.checksum)
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            reader.close()
+            self._reader.close()
+            db = self._connect()
+            # 替换文件时持有索引的写锁，其他进程提交前看不到新文件与旧偏移的组合
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany(
+                    "UPDATE pack SET offset = ? WHERE map_id = ?", [(i.offset, i.map_id) for i in compacted.values()]
+                )
+                tmp_path.replace(self.pack_path)
+            except BaseException:
+                db.rollback()
+                raise
+            db.commit()
+            self._entries = compacted
+            self._data_version = db.execute("PRAGMA data_version").fetchone()[0]
+
+    def close(self):
+        self._reader.close()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -1,9 +1,21 @@
+import asyncio
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional, Sequence
+
+from loguru import logger
 from rosu_pp_py import Beatmap, GameMode, Performance
 
+from .pack import PackEntry, read_entry
 
-def get_ss_pp(path: str, mods: int, mode: str) -> float:
-    beatmap = Beatmap(path=path)
-    convert_mode(beatmap, mode)
+
+def get_ss_pp(pack_path: str, entry: PackEntry, mods: int, mode: str) -> float:
+    beatmap = load_beatmap(pack_path, entry, mode)
     if mods & (1 << 9):
         mods -= 1 << 9
         mods += 1 << 6
@@ -11,6 +23,15 @@ def get_ss_pp(path: str, mods: int, mode: str) -> float:
     ss_pp_info = c.calculate(beatmap)
     return round(ss_pp_info.pp, 2)
 
+
+@lru_cache(maxsize=256)
+def load_beatmap(pack_path: str, entry: PackEntry, mode: str) -> Beatmap:
+    # entry 中带有内容的 md5，谱面更新后缓存键随之改变
+    beatmap = Beatmap(content=read_entry(pack_path, entry))
+    convert_mode(beatmap, mode)
+    return beatmap
+
+
 def convert_mode(beatmap: Beatmap, mode: str):
     if mode == "osu":
         mode = GameMode.Osu
@@ -23,3 +44,111 @@ def convert_mode(beatmap: Beatmap, mode: str):
     else:
         raise ValueError("Invalid mode")
     beatmap.convert(mode)
+
+
+def get_ss_pp_batch(pack_path: str, items: Sequence[tuple[PackEntry, int, str]]) -> list[Optional[float]]:
+    """在工作进程中批量计算，谱面直接从 pack 文件 mmap 读取，单个谱面出错时返回 None"""
+    result = []
+    for entry, mods, mode in items:
+        try:
+            result.append(get_ss_pp(pack_path, entry, mods, mode))
+        except Exception:
+            result.append(None)
+    return result
+
+
+def _warmup():
+    return os.getpid()
+
+
+class PPService:
+    """
+    在进程池中计算 SS pp，事件循环不会被 pp 计算阻塞
+
+    工作进程内用 lru_cache 缓存解析过的谱面，主进程按 (map_id, mods, mode) 缓存结果。
+    """
+
+    def __init__(self, pack_path: Path, workers: int = 2, cache_size: int = 4096):
+        self.pack_path = str(pack_path)
+        self.workers = workers
+        self.cache_size = cache_size
+        self._executor: Optional[Executor] = None
+        self._results: OrderedDict[tuple[int, int, str], tuple[str, Optional[float]]] = OrderedDict()
+
+    def _pool(self) -> Executor:
+        if self._executor is None:
+            if "fork" in multiprocessing.get_all_start_methods():
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("fork"))
+            else:
+                # spawn 出的子进程无法导入依赖 nonebot 的插件包，没有 fork 时退回线程池
+                self._executor = ThreadPoolExecutor(self.workers)
+        return self._executor
+
+    async def start(self):
+        """启动时预先创建工作进程，避免在处理请求时才 fork"""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._pool(), _warmup) for _ in range(self.workers)))
+
+    async def close(self):
+        self._reset()
+
+    def _reset(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(
+        self, pool: Executor, items: Sequence[tuple[PackEntry, int, str]], chunks: list[list[int]]
+    ) -> list[list[Optional[float]]]:
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*(
+            loop.run_in_executor(
+                pool, get_ss_pp_batch, self.pack_path, [(items[i][0], int(items[i][1]), items[i][2]) for i in chunk]
+            )
+            for chunk in chunks
+        ))
+
+    def _cached(self, key: tuple[int, int, str], checksum: str) -> tuple[bool, Optional[float]]:
+        if (item := self._results.get(key)) is not None and item[0] == checksum:
+            self._results.move_to_end(key)
+            return True, item[1]
+        return False, None
+
+    def _store(self, key: tuple[int, int, str], checksum: str, pp: Optional[float]):
+        self._results[key] = (checksum, pp)
+        self._results.move_to_end(key)
+        while len(self._results) > self.cache_size:
+            self._results.popitem(last=False)
+
+    async def ss_pp_batch(self, items: Sequence[tuple[PackEntry, int, str]]) -> list[Optional[float]]:
+        """items 为 (谱面在 pack 中的位置, mods, mode)，返回对应的 SS pp，计算失败为 None"""
+        result: list[Optional[float]] = [None] * len(items)
+        missing = []
+        for index, (entry, mods, mode) in enumerate(items):
+            hit, pp = self._cached((entry.map_id, int(mods), mode), entry.checksum)
+            if hit:
+                result[index] = pp
+            else:
+                missing.append(index)
+        if not missing:
+            return result
+        size = -(-len(missing) // self.workers)
+        chunks = [missing[i:i + size] for i in range(0, len(missing), size)]
+        pool = self._pool()
+        try:
+            outputs = await self._run(pool, items, chunks)
+        except BrokenProcessPool:
+            # 工作进程被 OOM 或 Rust 的 abort 杀死后进程池不可再用，重建后重试一次
+            logger.warning("pp 计算进程池已损坏，重建后重试")
+            # 并发的其他调用可能已经重建过，只重置自己用过的那个
+            if self._executor is pool:
+                self._reset()
+            outputs = await self._run(self._pool(), items, chunks)
+        for chunk, output in zip(chunks, outputs):
+            for index, pp in zip(chunk, output):
+                entry, mods, mode = items[index]
+                # 失败可能是 pack 内容损坏，不缓存，重新下载后可以再算
+                if pp is not None:
+                    self._store((entry.map_id, int(mods), mode), entry.checksum, pp)
+                result[index] = pp
+        return result
@@ -0,0 +1,100 @@
+import asyncio
+import hashlib
+from pathlib import Path
+from typing import Awaitable, Callable, Iterable, Optional
+
+from loguru import logger
+
+from .pack import BeatmapPack, PackEntry
+
+
+class OsuPrefetcher:
+    """
+    并发下载 .osu 文件存入 pack，同一 map_id 的并发请求共享同一个下载任务
+
+    已知谱面当前 checksum 时（参数传入或 checksum_hint 提供），pack 中内容不一致的谱面会重新下载。
+    pack 中的内容第一次用到时解压校验一次，损坏的删除索引后重新下载。
+    旧版按文件存放在 legacy_path 下的谱面第一次用到时导入 pack。
+    """
+
+    def __init__(
+        self,
+        download: Callable[[int], Awaitable[Optional[bytes]]],
+        pack: BeatmapPack,
+        legacy_path: Optional[Path] = None,
+        concurrency: int = 8,
+        checksum_hint: Optional[Callable[[int], Optional[str]]] = None,
+    ):
+        self.download = download
+        self.pack = pack
+        self.legacy_path = legacy_path
+        self.checksum_hint = checksum_hint
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._inflight: dict[int, asyncio.Task] = {}
+        self._verified: set[PackEntry] = set()
+
+    def _current(self, map_id: int, checksum: Optional[str]) -> Optional[PackEntry]:
+        entry = self.pack.get(map_id)
+        if entry is not None and (checksum is None or entry.checksum == checksum):
+            return entry
+        return None
+
+    async def ensure(self, map_id: int, checksum: Optional[str] = None) -> Optional[PackEntry]:
+        """返回谱面在 pack 中的位置，不存在或已过期时下载，下载失败返回 None"""
+        if checksum is None and self.checksum_hint is not None:
+            checksum = self.checksum_hint(map_id)
+        if (entry := self._current(map_id, checksum)) is not None and entry in self._verified:
+            return entry
+        task = self._inflight.get(map_id)
+        if task is None:
+            task = asyncio.create_task(self._download(map_id, checksum))
+            self._inflight[map_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(map_id, None))
+        return await asyncio.shield(task)
+
+    async def _valid(self, entry: Optional[PackEntry]) -> Optional[PackEntry]:
+        """校验 pack 中的内容，损坏时删除索引并返回 None"""
+        if entry is None or entry in self._verified:
+            return entry
+        if await asyncio.to_thread(self.pack.verify, entry):
+            self._verified.add(entry)
+            return entry
+        logger.warning(f"pack 中谱面 {entry.map_id} 的内容已损坏，重新下载")
+        await asyncio.to_thread(self.pack.discard, entry)
+        return None
+
+    def _legacy(self, map_id: int, checksum: Optional[str]) -> Optional[bytes]:
+        if self.legacy_path is None or not (file := self.legacy_path / f"{map_id}.osu").exists():
+            return None
+        content = file.read_bytes()
+        if checksum is not None and hashlib.md5(content).hexdigest() != checksum:
+            return None
+        return content
+
+    async def _download(self, map_id: int, checksum: Optional[str]) -> Optional[PackEntry]:
+        async with self._semaphore:
+            if (entry := await self._valid(self._current(map_id, checksum))) is not None:
+                return entry
+            content = await asyncio.to_thread(self._legacy, map_id, checksum)
+            if content is None:
+                try:
+                    content = await self.download(map_id)
+                except Exception as e:
+                    logger.warning(f"下载谱面 {map_id} 失败: {e}")
+                if content is None:
+                    # 下载失败时旧版本总比没有好
+                    return await self._valid(self.pack.get(map_id))
+                if checksum is not None and hashlib.md5(content).hexdigest() != checksum:
+                    logger.warning(f"谱面 {map_id} 下载内容的 md5 与 {checksum} 不一致，镜像可能尚未更新")
+            entry = await asyncio.to_thread(self.pack.put, map_id, content)
+            self._verified.add(entry)
+            return entry
+
+    async def prefetch(
+        self, map_ids: Iterable[int], checksums: Optional[dict[int, Optional[str]]] = None
+    ) -> dict[int, Optional[PackEntry]]:
+        """checksums 为已知的谱面当前 checksum，没有的谱面由 checksum_hint 提供"""
+        map_ids = list(dict.fromkeys(map_ids))
+        checksums = checksums or {}
+        entries = await asyncio.gather(*(self.ensure(i, checksums.get(i)) for i in map_ids))
+        return dict(zip(map_ids, entries))
@@ -0,0 +1,38 @@
+from typing import Optional
+
+import orjson
+
+from .mods import ModSet
+
+
+class BestScore:
+    """bp 的精简记录，只保留爬取和推荐用到的字段，渲染等需要完整信息时仍用 NewScore"""
+
+    __slots__ = ("beatmap_id", "mods", "pp", "checksum")
+
+    def __init__(self, beatmap_id: int, mods: tuple[str, ...], pp: Optional[float], checksum: Optional[str] = None):
+        self.beatmap_id = beatmap_id
+        self.mods = mods
+        self.pp = pp
+        self.checksum = checksum
+
+    @property
+    def mod(self) -> ModSet:
+        """与关系表 mod 列一致的位掩码"""
+        return ModSet.from_acronyms(self.mods)
+
+    def __repr__(self):
+        return f"BestScore({self.beatmap_id}, {self.mods}, {self.pp})"
+
+
+def decode_best_scores(content: bytes) -> list[BestScore]:
+    """用 orjson 解析 bp 列表，跳过 pydantic 对嵌套的谱面、谱面集、玩家模型的校验"""
+    return [
+        BestScore(
+            int(i["beatmap_id"]),
+            tuple(j["acronym"] for j in i["mods"]),
+            i.get("pp"),
+            (i.get("beatmap") or {}).get("checksum"),
+        )
+        for i in orjson.loads(content)
+    ]
@@ -0,0 +1,86 @@
+import asyncio
+import time
+from typing import Optional
+
+from loguru import logger
+
+from ..network import get_client
+
+token_url = "https://osu.ppy.sh/oauth/token"
+
+
+class TokenManager:
+    """
+    osu! client credentials token 管理
+
+    并发的续期请求合并为同一个请求；按服务器返回的 expires_in 在过期前 refresh_margin 秒后台续期。
+    """
+
+    def __init__(self, client_id: Optional[int], client_secret: Optional[str], refresh_margin: float = 300):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._renewing: Optional[asyncio.Task] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def _valid(self) -> bool:
+        # 留出少量余量，避免请求发出时 token 恰好过期
+        return self._token is not None and time.monotonic() < self._expires_at - 30
+
+    async def get(self) -> Optional[str]:
+        if self._valid():
+            return self._token
+        return await self.renew()
+
+    async def renew(self) -> Optional[str]:
+        if self._renewing is None or self._renewing.done():
+            self._renewing = asyncio.create_task(self._renew())
+        # shield 保证某个调用方被取消时不会取消其他调用方共享的续期请求
+        return await asyncio.shield(self._renewing)
+
+    async def _renew(self) -> Optional[str]:
+        req = await get_client().post(
+            token_url,
+            json={
+                "client_id": f"{self.client_id}",
+                "client_secret": f"{self.client_secret}",
+                "grant_type": "client_credentials",
+                "scope": "public",
+            },
+        )
+        if req.status_code != 200:
+            logger.error(f"更新OSU token出错 错误{req.status_code}")
+            self._schedule_refresh(60)
+            return self._token if self._valid() else None
+        data = req.json()
+        self._token = data["access_token"]
+        expires_in = data.get("expires_in", 86400)
+        self._expires_at = time.monotonic() + expires_in
+        self._schedule_refresh(max(expires_in - self.refresh_margin, 60))
+        return self._token
+
+    def _schedule_refresh(self, delay: float):
+        if self._refresh_task is not None and self._refresh_task is not asyncio.current_task():
+            self._refresh_task.cancel()
+        self._refresh_task = asyncio.create_task(self._refresh_later(delay))
+
+    async def _refresh_later(self, delay: float):
+        await asyncio.sleep(delay)
+        try:
+            await self.renew()
+        except Exception as e:
+            logger.warning(f"后台更新OSU token失败: {e}")
+            self._schedule_refresh(60)
+
+    def invalidate(self, token: Optional[str]):
+        """收到 401 时调用，只作废出错的那个 token，避免覆盖其他请求刚续期的新 token"""
+        if token == self._token:
+            self._token = None
+            self._expires_at = 0.0
+
+    async def close(self):
+        for task in (self._refresh_task, self._renewing):
+            if task is not None and not task.done():
+                task.cancel()
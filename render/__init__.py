@@ -0,0 +1,58 @@
+from typing import List
+
+from loguru import logger
+from nonebot import get_driver, get_plugin_config, require
+
+from ..config import Config
+from ..models import NewScore, Beatmap
+from .cache import RenderCache
+from .table import Leaderboard, build_leaderboard, relative_time
+
+plugin_config = get_plugin_config(Config)
+render_cache = RenderCache(plugin_config.osu_render_cache_size)
+driver = get_driver()
+
+if plugin_config.osu_render_backend == "pillow":
+    from .native import TableRenderer
+
+    renderer = TableRenderer(plugin_config.osu_render_font, width=1100)
+elif plugin_config.osu_render_backend == "browser":
+    require("nonebot_plugin_htmlrender")
+    from .browser import PagePool
+
+    renderer = PagePool(plugin_config.osu_render_pages, width=1100)
+
+    @driver.on_startup
+    async def _():
+        try:
+            await renderer.start()
+        except Exception as e:
+            # 预热失败不影响启动，首次渲染时再创建页面
+            logger.warning(f"预热渲染页面失败: {e}")
+
+    driver.on_shutdown(renderer.close)
+else:
+    raise ValueError(f"未知的渲染方式 {plugin_config.osu_render_backend}，可选 browser 或 pillow")
+
+
+async def render_pic(scores: List[NewScore], map_info: Beatmap, mode: str, mods: List[str], is_country: bool) -> bytes:
+    leaderboard = build_leaderboard(scores, map_info)
+    key = RenderCache.key(
+        map_info.id,
+        map_info.checksum,
+        mode,
+        tuple(mods),
+        is_country,
+        tuple(score.id for score in scores),
+        leaderboard.title,
+        leaderboard.subtitle,
+        tuple(tuple(row) for row in leaderboard.rows),
+    )
+    if (pic := render_cache.get(key)) is not None:
+        return pic
+    pic = await renderer.render(leaderboard)
+    render_cache.set(key, pic)
+    return pic
+
+
+__all__ = ["Leaderboard", "build_leaderboard", "relative_time", "render_pic", "renderer", "render_cache"]
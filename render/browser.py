@@ -0,0 +1,100 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
+from html import escape
+
+from nonebot_plugin_htmlrender import get_browser
+
+from .table import Leaderboard
+
+TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<style>
+body {{ margin: 0; padding: 32px; width: {width}px; box-sizing: border-box; background: #fff; color: #1f2328;
+  font-family: -apple-system, "Segoe UI", "Noto Sans CJK SC", "Microsoft YaHei", sans-serif; font-size: 16px; }}
+h3 {{ margin: 0 0 16px; font-size: 1.25em; font-weight: 600; }}
+p {{ margin: 0 0 16px; }}
+table {{ border-collapse: collapse; border-spacing: 0; }}
+th, td {{ padding: 6px 13px; border: 1px solid #d0d7de; white-space: nowrap; }}
+th {{ font-weight: 600; }}
+tr:nth-child(2n) {{ background: #f6f8fa; }}
+</style>
+</head>
+<body>
+<h3>{title}</h3>
+<p>{subtitle}</p>
+<table>
+<thead><tr>{header}</tr></thead>
+<tbody>{body}</tbody>
+</table>
+</body>
+</html>
+"""
+
+
+def leaderboard_html(leaderboard: Leaderboard, width: int) -> str:
+    return TEMPLATE.format(
+        width=width,
+        title=escape(leaderboard.title),
+        subtitle=escape(leaderboard.subtitle),
+        header="".join(f"<th>{escape(i)}</th>" for i in leaderboard.header),
+        body="".join(
+            "<tr>" + "".join(f"<td>{escape(i)}</td>" for i in row) + "</tr>" for row in leaderboard.rows
+        ),
+    )
+
+
+class PagePool:
+    """
+    预先打开的浏览器页面池，同时渲染的数量不超过页面数
+
+    页面创建失败或渲染出错时不占用名额，下次需要时重新创建。
+    """
+
+    def __init__(self, size: int = 2, width: int = 1100, device_scale_factor: float = 2):
+        self.size = size
+        self.width = width
+        self.device_scale_factor = device_scale_factor
+        self._semaphore = asyncio.Semaphore(size)
+        self._idle: list = []
+
+    async def _new_page(self):
+        browser = await get_browser()
+        return await browser.new_page(
+            device_scale_factor=self.device_scale_factor, viewport={"width": self.width, "height": 10}
+        )
+
+    async def start(self):
+        while len(self._idle) < self.size:
+            self._idle.append(await self._new_page())
+
+    @asynccontextmanager
+    async def page(self):
+        async with self._semaphore:
+            page = self._idle.pop() if self._idle else None
+            ok = False
+            try:
+                if page is None or page.is_closed():
+                    page = await self._new_page()
+                yield page
+                ok = True
+            finally:
+                if ok:
+                    self._idle.append(page)
+                elif page is not None and not page.is_closed():
+                    # 出错的页面状态未知，直接关闭，下次渲染时新建
+                    with suppress(Exception):
+                        await page.close()
+
+    async def close(self):
+        while self._idle:
+            page = self._idle.pop()
+            if not page.is_closed():
+                await page.close()
+
+    async def render(self, leaderboard: Leaderboard) -> bytes:
+        async with self.page() as page:
+            await page.set_viewport_size({"width": self.width, "height": 10})
+            await page.set_content(leaderboard_html(leaderboard, self.width))
+            return await page.screenshot(full_page=True, type="png")
@@ -0,0 +1,26 @@
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+
+
+class RenderCache:
+    """按内容哈希缓存渲染好的图片，超过容量时淘汰最久未使用的"""
+
+    def __init__(self, size: int = 64):
+        self.size = size
+        self._items: OrderedDict[str, bytes] = OrderedDict()
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        if (item := self._items.get(key)) is not None:
+            self._items.move_to_end(key)
+        return item
+
+    def set(self, key: str, value: bytes):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
@@ -0,0 +1,103 @@
+import asyncio
+from functools import lru_cache
+from io import BytesIO
+from pathlib import Path
+from typing import Optional
+
+from PIL import Image, ImageDraw, ImageFont
+from loguru import logger
+
+from .table import Leaderboard
+
+font_path = Path() / "data" / "osu" / "fonts"
+# 没有放置字体时按顺序尝试常见的系统中文字体
+SYSTEM_FONTS = [
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/System/Library/Fonts/PingFang.ttc",
+    "C:/Windows/Fonts/msyh.ttc",
+]
+BACKGROUND = "#ffffff"
+TEXT = "#1f2328"
+BORDER = "#d0d7de"
+STRIPE = "#f6f8fa"
+
+
+def find_font(path: Optional[str] = None) -> Optional[str]:
+    if path:
+        return path
+    if font_path.exists():
+        for pattern in ("*.ttf", "*.otf", "*.ttc"):
+            if fonts := sorted(font_path.glob(pattern)):
+                return str(fonts[0])
+    for i in SYSTEM_FONTS:
+        if Path(i).exists():
+            return i
+    return None
+
+
+@lru_cache(maxsize=8)
+def load_font(path: Optional[str], size: int) -> ImageFont.FreeTypeFont:
+    if path is None:
+        return ImageFont.load_default(size)
+    return ImageFont.truetype(path, size)
+
+
+class TableRenderer:
+    """
+    用 Pillow 直接把排行榜表格画成 PNG，不需要常驻浏览器
+
+    版式与浏览器渲染的表格一致：标题、难度星数、带边框和隔行底色的 12 列表格。
+    """
+
+    def __init__(self, font: Optional[str] = None, width: int = 1100, scale: int = 2):
+        self.font = find_font(font)
+        if self.font is None:
+            logger.warning(f"未找到中文字体，请把字体文件放到 {font_path} 或设置 osu_render_font")
+        self.width = width
+        self.scale = scale
+
+    def draw(self, leaderboard: Leaderboard) -> bytes:
+        s = self.scale
+        title_font = load_font(self.font, 20 * s)
+        font = load_font(self.font, 16 * s)
+        pad_x, pad_y, margin = 13 * s, 6 * s, 32 * s
+        ascent, descent = font.getmetrics()
+        row_height = ascent + descent + 2 * pad_y
+        table = [leaderboard.header, *leaderboard.rows]
+        widths = [
+            max(int(font.getlength(row[col])) for row in table) + 2 * pad_x
+            for col in range(len(leaderboard.header))
+        ]
+        title_height = sum(title_font.getmetrics()) + 16 * s
+        subtitle_height = ascent + descent + 16 * s
+        width = max(self.width * s, sum(widths) + 2 * margin)
+        height = 2 * margin + title_height + subtitle_height + row_height * len(table)
+
+        image = Image.new("RGB", (width, height), BACKGROUND)
+        draw = ImageDraw.Draw(image)
+        y = margin
+        draw.text((margin, y), leaderboard.title, font=title_font, fill=TEXT)
+        y += title_height
+        # 中文字体大多没有 emoji，换成普通的星号字符
+        draw.text((margin, y), leaderboard.subtitle.replace("⭐", "★"), font=font, fill=TEXT)
+        y += subtitle_height
+        for index, row in enumerate(table):
+            x = margin
+            if index and index % 2 == 0:
+                draw.rectangle((x, y, x + sum(widths), y + row_height), fill=STRIPE)
+            for col, text in enumerate(row):
+                draw.rectangle((x, y, x + widths[col], y + row_height), outline=BORDER, width=max(s // 2, 1))
+                draw.text((x + pad_x, y + pad_y), text, font=font, fill=TEXT)
+                x += widths[col]
+            y += row_height
+
+        buffer = BytesIO()
+        image.save(buffer, format="PNG", optimize=False)
+        return buffer.getvalue()
+
+    async def render(self, leaderboard: Leaderboard) -> bytes:
+        # 绘制和 PNG 编码都会占用 CPU，放到线程中执行
+        return await asyncio.to_thread(self.draw, leaderboard)
@@ -0,0 +1,55 @@
+import datetime
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from ..models import NewScore, Beatmap
+
+LEADERBOARD_HEADER = ["排名", "", "得分", "准确率", "玩家", "最大连击", "Fruits", "DRP MISS", "MISS", "PP", "达成时间", "模组"]
+
+
+@dataclass
+class Leaderboard:
+    title: str
+    subtitle: str
+    header: List[str] = field(default_factory=lambda: LEADERBOARD_HEADER)
+    rows: List[List[str]] = field(default_factory=list)
+
+
+def relative_time(play_time: datetime.datetime, now: Optional[datetime.datetime] = None) -> str:
+    """粗粒度的相对时间，一小时内不再细分，同一张榜在一段时间内渲染结果不变，缓存才能命中"""
+    time_delta = (now or datetime.datetime.now()) - play_time
+    if time_delta.days > 365:
+        return f"{time_delta.days // 365} 年前"
+    elif time_delta.days > 30:
+        return f"{time_delta.days // 30} 月前"
+    elif time_delta.days >= 1:
+        return f"{time_delta.days} 天前"
+    elif time_delta.seconds >= 3600:
+        return f"{time_delta.seconds // 3600} 小时前"
+    return "1 小时内"
+
+
+def build_leaderboard(scores: List[NewScore], map_info: Beatmap) -> Leaderboard:
+    leaderboard = Leaderboard(
+        title=f"{map_info.beatmapset.title} [{map_info.version}]",
+        subtitle=f"⭐{map_info.difficulty_rating:.2f}",
+    )
+    now = datetime.datetime.now()
+    for rank, score in enumerate(scores):
+        mods = [i.acronym for i in score.mods if i.acronym != "CL"]
+        play_time = datetime.datetime.strptime(score.ended_at, "%Y-%m-%dT%H:%M:%SZ") + datetime.timedelta(hours=8)
+        leaderboard.rows.append([
+            f"{rank + 1}",
+            f"{score.rank}",
+            f"{score.legacy_total_score}",
+            f"{(score.accuracy * 100):.1f}%",
+            f"{score.user.username}",
+            f"{score.max_combo}",
+            f"{score.statistics.great or 0}",
+            f"{score.statistics.small_tick_miss or 0}",
+            f"{score.statistics.miss or 0}",
+            f"{score.pp:.0f}",
+            relative_time(play_time, now),
+            " ".join(mods),
+        ])
+    return leaderboard
@@ -1,22 +1,52 @@
+from typing import Optional
+
+from expiringdict import ExpiringDict
+from nonebot import get_plugin_config
 from nonebot.internal.adapter import Event, Message
+from nonebot.internal.matcher import Matcher
 from nonebot.internal.params import Depends
+from nonebot.message import run_postprocessor
 from nonebot.params import T_State, CommandArg
 from nonebot_plugin_alconna import UniMsg, At
 from sqlmodel import select
 
+from .config import Config
 from .models import get_osu_session, User
 from .osu_network.mods import mods2list
 
+plugin_config = get_plugin_config(Config)
+# qq -> (osu_id, osu_mode)，未绑定的用户缓存为 None，绑定后由下面的钩子清除
+binding_cache = ExpiringDict(max_len=plugin_config.osu_binding_cache_size, max_age_seconds=plugin_config.osu_binding_cache_ttl)
+# 主 osubot 插件中会修改绑定的命令
+BINDING_COMMANDS = ("bind", "unbind", "更新模式")
+_missing = object()
+
+
+async def get_binding(qq: str) -> Optional[tuple[int, int]]:
+    if (binding := binding_cache.get(qq, _missing)) is not _missing:
+        return binding
+    async with get_osu_session() as session:
+        user_data = (await session.exec(select(User).where(User.user_id == qq))).first()
+    binding = (user_data.osu_id, user_data.osu_mode) if user_data else None
+    binding_cache[qq] = binding
+    return binding
+
+
+@run_postprocessor
+async def _(matcher: Matcher, event: Event):
+    command = matcher.state.get("_prefix", {}).get("command")
+    if command and command[0] in BINDING_COMMANDS:
+        binding_cache.pop(event.get_user_id(), None)
+
 
 def split_msg():
     async def dependency(event: Event, state: T_State, msg: UniMsg, arg: Message = CommandArg()):
         qq = event.get_user_id()
         if msg.has(At):
             qq = msg.get(At)[0].target
-        async with get_osu_session() as session:
-            user_data = (await session.exec(select(User).where(User.user_id == qq))).first()
-        state["user"] = user_data.osu_id if user_data else 0
-        state["mode"] = str(user_data.osu_mode) if user_data else "0"
+        binding = await get_binding(qq)
+        state["user"] = binding[0] if binding else 0
+        state["mode"] = str(binding[1]) if binding else "0"
         state["mods"] = []
         state["day"] = 0
         state["is_name"] = False